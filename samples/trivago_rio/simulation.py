@@ -23,11 +23,12 @@ class SimpleLinearModel(RecommenderModule):
         n_factors: int,
         metadata_size: int,
         window_hist_size: int,
+        sparse: bool = False,
     ):
         super().__init__(project_config, index_mapping)
 
-        self.user_embeddings = nn.Embedding(self._n_users, n_factors)
-        self.item_embeddings = nn.Embedding(self._n_items, n_factors)
+        self.user_embeddings = nn.Embedding(self._n_users, n_factors, sparse=sparse)
+        self.item_embeddings = nn.Embedding(self._n_items, n_factors, sparse=sparse)
 
         num_dense = n_factors + window_hist_size + 1 + metadata_size
 
@@ -19,11 +19,12 @@ class SimpleLinearModel(RecommenderModule):
         n_factors: int,
         metadata_size: int,
         window_hist_size: int,
+        sparse: bool = False,
     ):
         super().__init__(project_config, index_mapping)
 
-        self.user_embeddings = nn.Embedding(self._n_users, n_factors)
-        self.item_embeddings = nn.Embedding(self._n_items, n_factors)
+        self.user_embeddings = nn.Embedding(self._n_users, n_factors, sparse=sparse)
+        self.item_embeddings = nn.Embedding(self._n_items, n_factors, sparse=sparse)
 
         # user + item + flatten hist + position + metadata
         num_dense = 2 * n_factors + window_hist_size * n_factors + 1 + metadata_size
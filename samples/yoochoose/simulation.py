@@ -19,12 +19,13 @@ class SimpleLinearModel(RecommenderModule):
         project_config: ProjectConfig,
         index_mapping: Dict[str, Dict[Any, int]],
         n_factors: int,
+        sparse: bool = False,
     ):
         super().__init__(project_config, index_mapping)
 
-        self.user_embeddings = nn.Embedding(self._n_users, n_factors)
-        self.item_embeddings = nn.Embedding(self._n_items, n_factors)
-        self.dayofweek_embeddings = nn.Embedding(7, n_factors)
+        self.user_embeddings = nn.Embedding(self._n_users, n_factors, sparse=sparse)
+        self.item_embeddings = nn.Embedding(self._n_items, n_factors, sparse=sparse)
+        self.dayofweek_embeddings = nn.Embedding(7, n_factors, sparse=sparse)
 
         num_dense = n_factors * (2 + 5) + 1
 
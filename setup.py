@@ -79,7 +79,7 @@ setup(
         "matplotlib>=2.2,<3", "seaborn>=0.8,<1", "plotly>=4.4,<5", "streamlit==0.67.1",
         "torch==1.13.1", "torchbearer==0.5", "pytorch-nlp>=0.4",
         "scikit-learn>=0.21,<=0.22", "imbalanced-learn>=0.4,<1", "tensorboardx>=1.6,<2",
-        "tqdm<5", "requests>=2,<3", "diskcache>=3,<4", "psutil>=5,<6",
+        "tqdm<5", "requests>=2,<3", "diskcache>=3,<4", "psutil>=5,<6", "pyarrow>=0.17",
         "click>=7.0","docutils==0.15"
     ],
     extras_require={
@@ -47,6 +47,15 @@ def supervised(args: Tuple[str]):
     )
 
 
+@run.command(context_settings=dict(ignore_unknown_options=True,), add_help_option=False)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def sweep(args: Tuple[str]):
+    args_str = _process_args(args)
+    os.system(
+        f"PYTHONPATH=. luigi --module mars_gym.simulation.sweep HyperparameterSweep {args_str} --local-scheduler"
+    )
+
+
 @run.command(context_settings=dict(ignore_unknown_options=True,), add_help_option=False)
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 def data(args: Tuple[str]):
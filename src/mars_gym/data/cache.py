@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from mars_gym.meta_config import ProjectConfig
+
+logger = logging.getLogger(__name__)
+
+# Bump it whenever the preprocessing or the encoding of the data frames changes,
+# so old cache entries are not reused.
+DATA_FRAME_CACHE_VERSION = 1
+
+
+def file_fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def index_mapping_hash(index_mapping: Dict[str, Dict[Any, int]]) -> str:
+    md5 = hashlib.md5()
+    for key in sorted(index_mapping.keys()):
+        md5.update(key.encode())
+        for value, index in sorted(
+            (str(value), int(index)) for value, index in index_mapping[key].items()
+        ):
+            md5.update(("%s=%d;" % (value, index)).encode())
+    return md5.hexdigest()
+
+
+def project_config_fingerprint(project_config: ProjectConfig) -> List[Any]:
+    return [
+        (column.name, column.type.name, column.same_index_as)
+        for column in project_config.all_columns
+    ] + [project_config.available_arms_column_name]
+
+
+def data_frame_cache_key(paths: List[str], **extra_params) -> str:
+    payload = {
+        "version": DATA_FRAME_CACHE_VERSION,
+        "files": [file_fingerprint(path) for path in paths],
+        **extra_params,
+    }
+    return hashlib.md5(
+        json.dumps(payload, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def write_cached_data_frame(df: pd.DataFrame, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # Write to a temporary file first, so a killed process never leaves a partial entry behind
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        feather.write_feather(table, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_cached_data_frame(path: str) -> pd.DataFrame:
+    table = feather.read_table(path, memory_map=True)
+
+    # List columns become numpy arrays, converted a chunk at a time instead of building a
+    # python object per element
+    return pd.DataFrame(
+        {
+            field.name: table.column(field.name).to_numpy()
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type)
+            else table.column(field.name).to_pandas()
+            for field in table.schema
+        },
+        columns=table.schema.names,
+    )
+
+
+def cached_data_frame(path: str, build_fn: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    if os.path.exists(path):
+        try:
+            return read_cached_data_frame(path)
+        except (pa.ArrowException, OSError) as e:
+            logger.warning("Ignoring invalid data frame cache %s: %s", path, e)
+
+    df = build_fn()
+
+    try:
+        write_cached_data_frame(df, path)
+    except (pa.ArrowException, OSError) as e:
+        logger.warning("Could not cache the data frame in %s: %s", path, e)
+
+    return df
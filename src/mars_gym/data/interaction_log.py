@@ -0,0 +1,273 @@
+import collections
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Kinds stored in typed arrays, everything else is kept as python objects
+NUMERIC_KINDS = "biuf"
+
+
+def _storage_dtype(dtype: Any) -> np.dtype:
+    if isinstance(dtype, np.dtype) and dtype.kind in NUMERIC_KINDS:
+        return dtype
+    return np.dtype(object)
+
+
+def _is_list_value(value: Any) -> bool:
+    return isinstance(value, (list, tuple, np.ndarray))
+
+
+class GrowableArray(object):
+    """Typed array that doubles its capacity when full, so appending is amortized O(1)"""
+
+    def __init__(self, dtype: np.dtype, capacity: int = 1024) -> None:
+        self._data = np.empty(max(1, capacity), dtype=dtype)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _reserve(self, size: int) -> None:
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+
+    def append(self, value: Any) -> None:
+        self._reserve(self._size + 1)
+        self._data[self._size] = value
+        self._size += 1
+
+    def extend(self, values: Any) -> None:
+        if self._data.dtype == object:
+            values_array = np.empty(len(values), dtype=object)
+            values_array[:] = list(values)
+        else:
+            values_array = np.asarray(values, dtype=self._data.dtype)
+        self._reserve(self._size + len(values_array))
+        self._data[self._size : self._size + len(values_array)] = values_array
+        self._size += len(values_array)
+
+    @property
+    def values(self) -> np.ndarray:
+        # A view, valid until the next append
+        return self._data[: self._size]
+
+
+class InteractionLog(object):
+    """
+    Append-only log of interactions, stored column by column in growable typed arrays. List columns
+    are stored flattened, with the offsets of each row. The columns not given in dtypes get theirs
+    from the first value appended. A data frame is only built when to_data_frame is called.
+    """
+
+    def __init__(self, dtypes: Optional[Dict[str, Any]] = None, capacity: int = 1024) -> None:
+        self._dtypes = dict(dtypes or {})
+        self._capacity = capacity
+        self._size = 0
+        self._columns: Dict[str, GrowableArray] = {}
+        self._list_values: Dict[str, GrowableArray] = {}
+        self._list_offsets: Dict[str, GrowableArray] = {}
+        self._order: List[str] = list(self._dtypes.keys())
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._order)
+
+    def _create_column(self, column: str, value: Any) -> None:
+        if _is_list_value(value):
+            self._list_values[column] = GrowableArray(
+                _storage_dtype(np.asarray(value).dtype), self._capacity
+            )
+            offsets = GrowableArray(np.dtype(np.int64), self._capacity + 1)
+            # The previous rows get empty lists
+            offsets.extend(np.zeros(self._size + 1, dtype=np.int64))
+            self._list_offsets[column] = offsets
+        else:
+            if self._size > 0 or value is None:
+                dtype = np.dtype(object)
+            elif column in self._dtypes:
+                dtype = _storage_dtype(self._dtypes[column])
+            else:
+                dtype = _storage_dtype(np.asarray(value).dtype)
+            self._columns[column] = GrowableArray(dtype, self._capacity)
+            # The previous rows get None
+            self._columns[column].extend([None] * self._size)
+
+        if column not in self._order:
+            self._order.append(column)
+
+    def append(self, row: Dict[str, Any]) -> None:
+        for column in self._order + [column for column in row if column not in self._order]:
+            value = row.get(column)
+            if column not in self._columns and column not in self._list_values:
+                self._create_column(column, value)
+
+            if column in self._list_values:
+                values = self._list_values[column]
+                if value is not None:
+                    values.extend(value)
+                self._list_offsets[column].append(len(values))
+            else:
+                self._columns[column].append(value)
+        self._size += 1
+
+    def column(self, column: str) -> np.ndarray:
+        """The values of a scalar column, as a view valid until the next append"""
+        if column not in self._columns:
+            return np.empty(0, dtype=_storage_dtype(self._dtypes[column]))
+        return self._columns[column].values
+
+    def list_column(self, column: str) -> List[list]:
+        values = self._list_values[column].values
+        offsets = self._list_offsets[column].values
+        return [values[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def to_data_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                column: self.list_column(column)
+                if column in self._list_values
+                else self.column(column).copy()
+                for column in self._order
+            },
+            columns=self._order,
+        )
+
+
+class UserItemCounter(object):
+    """
+    Views and outputs of each (user, item) pair, keyed by user * n_items + item. The counts are kept
+    in sorted arrays, for vectorized lookups, and the new pairs wait in a buffer that is merged into
+    them once it has buffer_size pairs, or a quarter as many as the arrays, so adding is amortized
+    O(1).
+    """
+
+    def __init__(self, n_items: int, buffer_size: int = 1024) -> None:
+        self.n_items = n_items
+        self.buffer_size = buffer_size
+        self._keys = np.empty(0, dtype=np.int64)
+        self._views = np.empty(0, dtype=np.int32)
+        self._outputs = np.empty(0, dtype=np.int32)
+        self._buffer: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys) + len(self._buffer)
+
+    def _get_keys(self, users: Any, items: Any) -> np.ndarray:
+        return np.asarray(users, dtype=np.int64) * self.n_items + np.asarray(items, dtype=np.int64)
+
+    def add(self, user: int, item: int, output: int) -> None:
+        key = int(user) * self.n_items + int(item)
+        position = np.searchsorted(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            self._views[position] += 1
+            self._outputs[position] += output
+            return
+
+        counts = self._buffer.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += output
+        if len(self._buffer) >= max(self.buffer_size, len(self._keys) // 4):
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        keys = np.fromiter(self._buffer.keys(), dtype=np.int64, count=len(self._buffer))
+        counts = np.array(list(self._buffer.values()), dtype=np.int32).reshape(-1, 2)
+        order = np.argsort(keys)
+        keys, counts = keys[order], counts[order]
+
+        # The buffered keys are never in the arrays, so they are only inserted in order
+        positions = np.searchsorted(self._keys, keys)
+        self._keys = np.insert(self._keys, positions, keys)
+        self._views = np.insert(self._views, positions, counts[:, 0])
+        self._outputs = np.insert(self._outputs, positions, counts[:, 1])
+        self._buffer = {}
+
+    def get(self, users: Any, items: Any) -> Tuple[np.ndarray, np.ndarray]:
+        """The views and outputs of each (users[i], items[i]), zero for the pairs never seen"""
+        keys = self._get_keys(users, items)
+        views = np.zeros(len(keys), dtype=np.int32)
+        outputs = np.zeros(len(keys), dtype=np.int32)
+
+        if len(self._keys) > 0:
+            positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            found = self._keys[positions] == keys
+            views[found] = self._views[positions[found]]
+            outputs[found] = self._outputs[positions[found]]
+
+        if self._buffer:
+            for i in np.flatnonzero(np.isin(keys, list(self._buffer.keys()))):
+                views[i], outputs[i] = self._buffer[int(keys[i])]
+
+        return views, outputs
+
+
+class ItemActionCounter(object):
+    """
+    How many times each item was the action, indexed by item, to get the propensity of an action
+    in O(1). With decay < 1, each action weights decay times the one after it. With window > 0,
+    only the last window actions are counted.
+    """
+
+    # The weights are rescaled before they overflow
+    MAX_WEIGHT = 1e100
+
+    def __init__(self, n_items: int, decay: float = 1.0, window: int = 0) -> None:
+        if not 0 < decay <= 1:
+            raise ValueError("decay must be in (0, 1]")
+        if window > 0 and decay < 1:
+            raise ValueError("Only one of decay and window can be used")
+
+        self.decay = decay
+        self.window = window
+        self._counts = np.zeros(n_items, dtype=np.float64)
+        self._total = 0.0
+        self._weight = 1.0
+        self._window_items: Deque[int] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def add(self, items: Any) -> None:
+        items = np.atleast_1d(np.asarray(items, dtype=np.int64))
+
+        if self.window > 0:
+            for item in items.tolist():
+                if len(self._window_items) == self.window:
+                    self._counts[self._window_items.popleft()] -= 1
+                    self._total -= 1
+                self._window_items.append(item)
+                self._counts[item] += 1
+                self._total += 1
+            return
+
+        # Instead of decaying all the counts, the new actions weight more. The items are added in
+        # segments whose weights grow at most MAX_WEIGHT times, rescaling between them
+        segment_size = len(items)
+        if self.decay < 1:
+            segment_size = max(1, int(np.log(self.MAX_WEIGHT) / -np.log(self.decay)))
+
+        for start in range(0, len(items), segment_size):
+            weights = self._weight / self.decay ** np.arange(len(items[start : start + segment_size]))
+            np.add.at(self._counts, items[start : start + segment_size], weights)
+            self._total += weights.sum()
+            self._weight = weights[-1] / self.decay
+
+            if self._weight > self.MAX_WEIGHT:
+                self._counts /= self._weight
+                self._total /= self._weight
+                self._weight = 1.0
+
+    def probs(self, items: Any) -> np.ndarray:
+        """The share of the counted actions of each item, zero before any action"""
+        items = np.asarray(items, dtype=np.int64)
+        if self._total <= 0:
+            return np.zeros(items.shape, dtype=np.float64)
+        return self._counts[items] / self._total
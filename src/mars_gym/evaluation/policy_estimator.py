@@ -26,6 +26,7 @@ class PolicyEstimatorTraining(TorchModelTraining):
     )
 
     embedding_dim: int = luigi.IntParameter(default=50)
+    sparse_embeddings: bool = luigi.BoolParameter(default=False)
     epochs = luigi.IntParameter(default=500)
     early_stopping_patience: int = luigi.IntParameter(default=20)
     metrics = luigi.ListParameter(default=["loss", "acc"])
@@ -51,4 +52,5 @@ class PolicyEstimatorTraining(TorchModelTraining):
             layers=self.layers,
             sample_batch=self.get_sample_batch(),
             weight_init=TORCH_WEIGHT_INIT[self.weight_init],
+            sparse=self.sparse_embeddings,
         )
@@ -76,10 +76,11 @@ class FillPropensityScoreMixin(object, metaclass=abc.ABCMeta):
         #embed()
         trial = (
             Trial(
-                self.policy_estimator.get_trained_module(),
+                self.policy_estimator.trained_module,
                 criterion=lambda *args: torch.zeros(
                     1, device=self.policy_estimator.torch_device, requires_grad=True
                 ),
+                callbacks=self.policy_estimator.get_precision_callbacks(),
             )
             .with_generators(val_generator=data_loader)
             .to(self.policy_estimator.torch_device)
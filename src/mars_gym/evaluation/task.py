@@ -1,4 +1,5 @@
 import functools
+import itertools
 import json
 import os
 from multiprocessing.pool import Pool
@@ -9,6 +10,7 @@ import abc
 import luigi
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import torch
 import torchbearer
 from torchbearer import Trial
@@ -77,6 +79,11 @@ class BaseEvaluationTask(luigi.Task, metaclass=abc.ABCMeta):
 
         return self._model_training
 
+    def set_model_training(self, model_training: TorchModelTraining) -> None:
+        # Reuses a model training already in memory, like the one running the evaluation
+        assert model_training.task_id == self.model_task_id
+        self._model_training = model_training
+
     @property
     def n_items(self):
         return self.model_training.n_items
@@ -198,24 +205,45 @@ class EvaluateTestSetPredictions(FillPropensityScoreMixin, BaseEvaluationTask):
     def get_catalog(self, df: pd.DataFrame) -> List[str]:
         indexed_list = self.get_item_index()
 
-        test_list    = list(df["sorted_actions"])
-        test_list.append(indexed_list)
-
-        all_items = sum(test_list, [])
+        all_items = list(itertools.chain(indexed_list, *df["sorted_actions"]))
         unique_items = list(np.unique(all_items))
         return unique_items
 
+    def _with_item_as_str(self, df: pd.DataFrame) -> pd.DataFrame:
+        # The same types read from the csv predictions file
+        item_column = self.model_training.project_config.item_column.name
+        df[item_column] = df[item_column].where(
+            df[item_column].isna(), df[item_column].astype(str)
+        )
+        return df
+
+    @property
+    def test_set_predictions(self) -> pd.DataFrame:
+        if not hasattr(self, "_test_set_predictions"):
+            task_dir = self.model_training.output().path
+            parquet_path = get_test_set_predictions_path(task_dir, "parquet")
+            if os.path.exists(parquet_path):
+                # The list columns come as numpy arrays over the Arrow buffers, without parsing
+                df: pd.DataFrame = self._with_item_as_str(pq.read_table(parquet_path).to_pandas())
+            else:
+                df: pd.DataFrame = pd.read_csv(
+                    get_test_set_predictions_path(task_dir),
+                    dtype = {self.model_training.project_config.item_column.name : "str"}
+                )  # .sample(10000)
+
+                df["sorted_actions"] = parallel_literal_eval(df["sorted_actions"])
+                df["prob_actions"]   = parallel_literal_eval(df["prob_actions"])
+                df["action_scores"]  = parallel_literal_eval(df["action_scores"])
+            self._test_set_predictions = df
+        return self._test_set_predictions
+
+    def set_test_set_predictions(self, df: pd.DataFrame) -> None:
+        self._test_set_predictions = self._with_item_as_str(df.copy())
+
     def run(self):
         os.makedirs(self.output().path)
 
-        df: pd.DataFrame = pd.read_csv(
-            get_test_set_predictions_path(self.model_training.output().path),
-            dtype = {self.model_training.project_config.item_column.name : "str"}
-        )  # .sample(10000)
-
-        df["sorted_actions"] = parallel_literal_eval(df["sorted_actions"])
-        df["prob_actions"]   = parallel_literal_eval(df["prob_actions"])
-        df["action_scores"]  = parallel_literal_eval(df["action_scores"])
+        df = self.test_set_predictions
 
         df["action"] = df["sorted_actions"].apply(
             lambda sorted_actions: str(sorted_actions[0])
@@ -553,10 +581,11 @@ class EvaluateTestSetPredictions(FillPropensityScoreMixin, BaseEvaluationTask):
         #from IPython import embed; embed()
         trial = (
             Trial(
-                self.direct_estimator.get_trained_module(),
+                self.direct_estimator.trained_module,
                 criterion=lambda *args: torch.zeros(
                     1, device=self.direct_estimator.torch_device, requires_grad=True
                 ),
+                callbacks=self.direct_estimator.get_precision_callbacks(),
             )
             .with_generators(val_generator=data_loader)
             .to(self.direct_estimator.torch_device)
@@ -1,5 +1,6 @@
-import collections
-from typing import Tuple, List, Any, Dict, Optional
+import collections.abc
+import itertools
+from typing import Tuple, List, Dict, Optional, Sequence
 
 import gym
 import numpy as np
@@ -10,6 +11,42 @@ from gym import utils
 ITEM_METADATA_KEY = "item_metadata"
 
 
+class IndexList(spaces.Space):
+    """
+    Sorted indices of the items set in a MultiBinary(n), which is what they are when densified.
+    Unlike it, the size depends on how many are set, not on n.
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        super().__init__((), np.int64)
+
+    def sample(self) -> np.ndarray:
+        size = self.np_random.randint(self.n + 1)
+        return np.sort(self.np_random.choice(self.n, size, replace=False))
+
+    def contains(self, x) -> bool:
+        x = np.asarray(x)
+        return (
+            x.ndim == 1
+            and (len(x) == 0 or np.issubdtype(x.dtype, np.integer))
+            and bool(((x >= 0) & (x < self.n)).all())
+            and bool((np.diff(x) > 0).all())
+        )
+
+    def to_jsonable(self, sample_n):
+        return [np.asarray(sample).tolist() for sample in sample_n]
+
+    def from_jsonable(self, sample_n):
+        return [np.asarray(sample, dtype=np.int64) for sample in sample_n]
+
+    def __repr__(self):
+        return "IndexList({})".format(self.n)
+
+    def __eq__(self, other):
+        return isinstance(other, IndexList) and self.n == other.n
+
+
 class RecSysEnv(gym.Env, utils.EzPickle):
     metadata = {"render.modes": []}
     reward_range = [0.0, 1.0]
@@ -21,45 +58,46 @@ class RecSysEnv(gym.Env, utils.EzPickle):
         number_of_items: int,
         available_items_column: Optional[str] = None,
         item_metadata: Optional[Dict[str, np.ndarray]] = None,
+        dense_available_items: bool = False,
     ):
         super().__init__()
-        self._dataset = dataset.copy()
         self._item_metadata = item_metadata
         self._item_column = item_column
         self._available_items_column = available_items_column
+        self._dense_available_items = dense_available_items
 
         self._number_of_items = (
             number_of_items  # number_of_itemsdataset[item_column].max() + 1
         )
 
+        # Backed by an array per column, so a step only indexes them
+        self._size = len(dataset)
+        self._items = dataset[item_column].to_numpy()
+        self._obs_columns: Dict[str, np.ndarray] = {
+            key: dataset[key].to_numpy()
+            for key in dataset.columns
+            if key not in (item_column, available_items_column)
+        }
+
         if available_items_column:
             assert isinstance(
-                self._dataset[available_items_column].values[0], collections.Sequence
-            )
-            available_items = np.zeros(
-                (len(self._dataset), self._number_of_items), dtype=np.int8
+                dataset[available_items_column].values[0],
+                (collections.abc.Sequence, np.ndarray),
             )
-            non_zero_indices = [
-                (i, available_item)
-                for i, available_items in enumerate(
-                    self._dataset[available_items_column]
-                )
-                for available_item in available_items
-            ]
-            i, j = zip(*non_zero_indices)
-            available_items[i, j] = 1
-            self._dataset[available_items_column] = list(iter(available_items))
-
-        self._obs_dataset: List[dict] = self._dataset.drop(
-            columns=[item_column]
-        ).to_dict("records")
+            self._set_available_items(dataset[available_items_column].values)
 
         self.action_space = spaces.Discrete(self._number_of_items)
 
         observation_space = {
-            key: self._convert_value_to_space(key, value)
-            for key, value in self._obs_dataset[0].items()
+            key: self._convert_column_to_space(key, values)
+            for key, values in self._obs_columns.items()
         }
+        if available_items_column:
+            observation_space[available_items_column] = (
+                spaces.MultiBinary(self._number_of_items)
+                if dense_available_items
+                else IndexList(self._number_of_items)
+            )
         if item_metadata is not None:
             observation_space[ITEM_METADATA_KEY] = spaces.Dict(
                 {
@@ -72,31 +110,52 @@ class RecSysEnv(gym.Env, utils.EzPickle):
         self.observation_space = spaces.Dict(observation_space)
         self._current_index = 0
 
-    def _convert_value_to_space(self, key: str, value: Any) -> spaces.Space:
-        if isinstance(value, list):
-            value = np.array(value)
-
-        if key == self._available_items_column:
-            return spaces.MultiBinary(self._number_of_items)
-        if isinstance(value, int):
-            return spaces.Discrete(self._dataset[key].max() + 1)
-        elif isinstance(value, float):
-            return spaces.Box(
-                self._dataset[key].min(), self._dataset[key].max(), shape=(1,)
-            )
-        elif isinstance(value, np.ndarray):
+    def _set_available_items(self, available_items_list: Sequence[Sequence[int]]) -> None:
+        # Kept as CSR: the sorted, unique items of row i are indices[offsets[i]:offsets[i + 1]]
+        lengths = np.array([len(available_items) for available_items in available_items_list])
+        rows = np.repeat(np.arange(len(available_items_list)), lengths)
+        items = np.fromiter(
+            itertools.chain.from_iterable(available_items_list),
+            dtype=np.int64,
+            count=lengths.sum(),
+        )
+
+        order = np.lexsort((items, rows))
+        rows, items = rows[order], items[order]
+        keep = np.ones(len(items), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (items[1:] != items[:-1])
+
+        self._available_items_indices = items[keep]
+        self._available_items_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(rows[keep], minlength=len(available_items_list)))]
+        )
+
+    def _get_available_items(self, index: int) -> np.ndarray:
+        available_items = self._available_items_indices[
+            self._available_items_offsets[index] : self._available_items_offsets[index + 1]
+        ]
+        if self._dense_available_items:
+            multi_binary = np.zeros(self._number_of_items, dtype=np.int8)
+            multi_binary[available_items] = 1
+            return multi_binary
+        return available_items.copy()
+
+    def _convert_column_to_space(self, key: str, values: np.ndarray) -> spaces.Space:
+        if values.dtype.kind in "biu":
+            return spaces.Discrete(int(values.max()) + 1)
+        elif values.dtype.kind == "f":
+            return spaces.Box(values.min(), values.max(), shape=(1,))
+        elif len(values) > 0 and isinstance(values[0], (list, np.ndarray)):
+            value = np.array(values[0])
+            all_values = np.concatenate(list(values))
             if issubclass(value.dtype.type, np.integer):
-                return spaces.MultiDiscrete(
-                    [np.max(self._dataset[key].max()) + 1] * len(value)
-                )
+                return spaces.MultiDiscrete([all_values.max() + 1] * len(value))
             elif issubclass(value.dtype.type, np.floating):
-                return spaces.Box(
-                    self._dataset[key].min(),
-                    self._dataset[key].max(),
-                    shape=value.shape,
-                )
+                return spaces.Box(all_values.min(), all_values.max(), shape=value.shape)
         raise ValueError(
-            "Unkown type in the observation space for {}:{}".format(key, value)
+            "Unkown type in the observation space for {}:{}".format(
+                key, values[0] if len(values) > 0 else None
+            )
         )
 
     def _compute_stats(self, action: float) -> dict:
@@ -104,26 +163,36 @@ class RecSysEnv(gym.Env, utils.EzPickle):
         return {}
 
     def _compute_reward(self, action: int) -> float:
+        return float(self._items[self._current_index] == action)
 
-        return float(
-            self._dataset.iloc[self._current_index][self._item_column] == action
-        )
-
-    def _get_next_ob(self) -> dict:
-        ob = self._obs_dataset[self._current_index].copy()
+    def _get_ob(self, index: int) -> dict:
+        ob = {key: values.item(index) for key, values in self._obs_columns.items()}
+        if self._available_items_column:
+            ob[self._available_items_column] = self._get_available_items(index)
         if self._item_metadata is not None:
             ob[ITEM_METADATA_KEY] = self._item_metadata
         else:
             ob[ITEM_METADATA_KEY] = None
         return ob
 
+    def _get_next_ob(self) -> dict:
+        return self._get_ob(self._current_index)
+
+    def peek(self, n: int) -> List[dict]:
+        """
+        The next n observations after the current one, without stepping. They don't depend on the
+        actions, so they can be acted on together. The episode ends before the last row.
+        """
+        end = min(self._current_index + 1 + n, self._size - 1)
+        return [self._get_ob(index) for index in range(self._current_index + 1, end)]
+
     def step(self, action: int) -> Tuple[dict, float, bool, dict]:
         reward = self._compute_reward(action)
         info = self._compute_stats(action)
 
         self._current_index += 1
 
-        done = (self._current_index + 1) == len(self._dataset)
+        done = (self._current_index + 1) == self._size
         next_ob = self._get_next_ob() if not done else None
 
         return next_ob, reward, done, info
@@ -1,6 +1,7 @@
 import abc
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
+import torch
 import torch.nn as nn
 
 from mars_gym.meta_config import ProjectConfig
@@ -16,6 +17,37 @@ class RecommenderModule(nn.Module, metaclass=abc.ABCMeta):
         self._n_users = max(index_mapping[project_config.user_column.name].values()) + 1
         self._n_items = max(index_mapping[project_config.item_column.name].values()) + 1
 
-    
+
     def recommendation_score(self, *args):
-        return self.forward(*args)
\ No newline at end of file
+        return self.forward(*args)
+
+    @property
+    def has_representations(self) -> bool:
+        # The hooks give None unless the module implements them, even for no ids
+        device = next(self.parameters(), torch.empty(0)).device
+        ids = torch.zeros(0, dtype=torch.int64, device=device)
+        with torch.no_grad():
+            return (
+                self.user_representation(ids) is not None
+                and self.item_representation(ids) is not None
+            )
+
+    def user_representation(self, user_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Optional: the representation of the users whose dot product with the representation of the
+        items gives the recommendation score, through representation_score, allowing to score
+        the whole catalog at once. Only for modules whose score depends only on the user and the item.
+        None if the module doesn't have it.
+        """
+        return None
+
+    def item_representation(self, item_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Optional: the representation of the items, the counterpart of user_representation. None if
+        the module doesn't have it.
+        """
+        return None
+
+    def representation_score(self, dot_products: torch.Tensor) -> torch.Tensor:
+        """Turns the dot products into the recommendation scores, it must keep their order"""
+        return dot_products
@@ -43,6 +43,20 @@ class BanditAgent(object):
                 arm_indices, arm_contexts=arm_contexts, arm_scores=arm_scores
             )
 
+    def act_batch(
+        self,
+        arm_indices_list: List[List[int]],
+        arm_contexts_list: List[Tuple[np.ndarray, ...]],
+        arm_scores_list: List[Optional[List[float]]],
+    ) -> List[Tuple[int, float]]:
+        # In order, so the state of the policy evolves as if they were acted on one by one
+        return [
+            self.act(arm_indices, arm_contexts, arm_scores)
+            for arm_indices, arm_contexts, arm_scores in zip(
+                arm_indices_list, arm_contexts_list, arm_scores_list
+            )
+        ]
+
     def rank(
         self,
         arms: List[Any],
@@ -57,3 +71,27 @@ class BanditAgent(object):
             arm_scores=arm_scores,
             with_probs=True,
         )
+
+    def rank_batch(
+        self,
+        arms: np.ndarray,
+        arm_scores: np.ndarray,
+        mask: np.ndarray,
+        arm_contexts_list: Optional[List[Tuple[np.ndarray, ...]]] = None,
+        limit: Optional[int] = None,
+        arm_indices: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        ranked_positions, propensities, sorted_scores = self.bandit.rank_batch(
+            arm_scores,
+            mask,
+            arm_contexts_list=arm_contexts_list,
+            limit=limit,
+            arms=arms,
+            arm_indices=arm_indices,
+        )
+        ranked_arms = np.take_along_axis(
+            np.asarray(arms, dtype=object), np.maximum(ranked_positions, 0), axis=1
+        )
+        ranked_arms[ranked_positions < 0] = None
+
+        return ranked_arms, propensities, sorted_scores
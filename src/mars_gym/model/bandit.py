@@ -14,6 +14,17 @@ from tqdm import tqdm
 from mars_gym.utils.utils import chunks
 
 
+def _top_k(keys: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+    # Stable, so the ties keep their order like np.argmax over the remaining arms
+    order = np.argsort(np.where(mask, -keys, np.inf), axis=1, kind="stable")[:, :k]
+    return np.where(np.take_along_axis(mask, order, axis=1), order, -1)
+
+
+def _gather(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    gathered = np.take_along_axis(values, np.maximum(positions, 0), axis=1)
+    return np.where(positions >= 0, gathered, np.nan)
+
+
 class BanditPolicy(object, metaclass=abc.ABCMeta):
     def __init__(self, reward_model: nn.Module) -> None:
         self.reward_model = reward_model
@@ -119,6 +130,79 @@ class BanditPolicy(object, metaclass=abc.ABCMeta):
         else:
             return ranked_arms
 
+    def _rank_batch(
+        self, arm_scores: np.ndarray, mask: np.ndarray, k: int
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Ranks all the observations at once, returning the ranked positions and their propensities,
+        or None if the policy can only rank one observation at a time.
+        """
+        return None
+
+    def _rank_batch_one_by_one(
+        self,
+        arm_scores: np.ndarray,
+        mask: np.ndarray,
+        k: int,
+        arm_contexts_list: Optional[List[Tuple[np.ndarray, ...]]],
+        arms: Optional[np.ndarray],
+        arm_indices: Optional[np.ndarray],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ranked_positions = np.full((len(arm_scores), k), -1, dtype=np.int64)
+        propensities = np.full((len(arm_scores), k), np.nan)
+
+        for i, n_arms in enumerate(mask.sum(axis=1)):
+            positions = list(range(n_arms))
+            # The real arms go with their positions, so the policy breaks the ties by them as
+            # when it ranks a single observation, and the positions are taken back from them
+            ranked, probs = self.rank(
+                positions if arms is None else list(zip(arms[i, :n_arms].tolist(), positions)),
+                positions if arm_indices is None else arm_indices[i, :n_arms].tolist(),
+                arm_contexts=arm_contexts_list[i] if arm_contexts_list else None,
+                arm_scores=arm_scores[i, :n_arms].tolist(),
+                with_probs=True,
+                limit=k,
+            )
+            ranked_positions[i, : len(ranked)] = (
+                ranked if arms is None else [position for _, position in ranked]
+            )
+            propensities[i, : min(len(probs), k)] = probs[:k]
+
+        return ranked_positions, propensities
+
+    def rank_batch(
+        self,
+        arm_scores: np.ndarray,
+        mask: np.ndarray,
+        arm_contexts_list: List[Tuple[np.ndarray, ...]] = None,
+        limit: int = None,
+        arms: np.ndarray = None,
+        arm_indices: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Ranks a batch of observations from their (n_obs x max_arms) scores, with the arms of each
+        observation first and the padding, False in the mask, last. The arms and arm_indices, padded
+        the same way, are only needed by the policies that rank one observation at a time.
+        Returns the ranked positions of the arms, their propensities and the scores sorted in
+        descending order, as (n_obs x k) arrays padded with -1 and nan.
+        """
+        arm_scores = np.asarray(arm_scores, dtype=np.float64)
+        mask = np.asarray(mask, dtype=bool)
+        k = arm_scores.shape[1] if limit is None else min(arm_scores.shape[1], limit)
+
+        self._limit = limit
+        ranked = self._rank_batch(arm_scores, mask, k)
+        if ranked is None:
+            ranked = self._rank_batch_one_by_one(
+                arm_scores, mask, k, arm_contexts_list, arms, arm_indices
+            )
+        ranked_positions, propensities = ranked
+
+        sorted_scores = -np.sort(np.where(mask, -arm_scores, np.inf), axis=1)[:, :k]
+        sorted_scores[~mask[:, :k]] = np.nan
+
+        return ranked_positions, propensities, sorted_scores
+
 
 class RandomPolicy(BanditPolicy):
     def __init__(self, reward_model: nn.Module, seed: int = 42) -> None:
@@ -194,6 +278,20 @@ class ModelPolicy(BanditPolicy):
         super().__init__(reward_model)
         self._rng = RandomState(seed)
 
+    def _compute_prob_batch(self, arm_scores: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        arms_probs = np.where(mask, 0.0, np.nan)
+        arms_probs[:, :1][mask[:, :1]] = 1.0
+        return arms_probs
+
+    def _rank_batch(
+        self, arm_scores: np.ndarray, mask: np.ndarray, k: int
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        ranked_positions = _top_k(arm_scores, mask, k)
+        return (
+            ranked_positions,
+            _gather(self._compute_prob_batch(arm_scores, mask), ranked_positions),
+        )
+
     def _select_idx(
         self,
         arm_indices: List[int],
@@ -311,6 +409,40 @@ class EpsilonGreedy(BanditPolicy):
 
         return arms_probs.tolist()
 
+    def _rank_batch(
+        self, arm_scores: np.ndarray, mask: np.ndarray, k: int
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        n_obs = len(arm_scores)
+        rows = np.arange(n_obs)
+        masked_scores = np.where(mask, arm_scores, -np.inf)
+
+        # The epsilon decays after the first position of each observation
+        epsilons = self._epsilon * self._epsilon_decay ** np.arange(n_obs)
+        arms_probs = np.where(mask, epsilons[:, None] / mask.sum(axis=1, keepdims=True), np.nan)
+        arms_probs[rows, np.argmax(masked_scores, axis=1)] += 1 - epsilons
+
+        ranked_positions = np.full((n_obs, k), -1, dtype=np.int64)
+        remaining = mask.copy()
+        for pos in range(k):
+            epsilon = epsilons if pos == 0 else epsilons * self._epsilon_decay
+            active = remaining.any(axis=1)
+            explore = active & (self._rng.random_sample(n_obs) < epsilon)
+
+            action = np.argmax(np.where(remaining, masked_scores, -np.inf), axis=1)
+            if explore.any():
+                # A uniformly random remaining arm
+                random_keys = self._rng.random_sample((int(explore.sum()), mask.shape[1]))
+                action[explore] = np.argmax(
+                    np.where(remaining[explore], random_keys, -1.0), axis=1
+                )
+
+            ranked_positions[active, pos] = action[active]
+            remaining[rows[active], action[active]] = False
+
+        self._epsilon *= self._epsilon_decay ** n_obs
+
+        return ranked_positions, _gather(arms_probs, ranked_positions)
+
     def _select_idx(
         self,
         arm_indices: List[int],
@@ -719,6 +851,22 @@ class SoftmaxExplorer(BanditPolicy):
         arms_probs = self._softmax(self._logit_multiplier * arm_scores)
         return arms_probs.tolist()
 
+    def _rank_batch(
+        self, arm_scores: np.ndarray, mask: np.ndarray, k: int
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self._reverse_sigmoid:
+            arm_scores = np.log(arm_scores + 1e-8 / ((1 - arm_scores) + 1e-8))
+        logits = np.where(mask, self._logit_multiplier * arm_scores, -np.inf)
+
+        arms_probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        arms_probs /= arms_probs.sum(axis=1, keepdims=True)
+
+        # Gumbel-top-k: sampling without replacement from the softmax, like drawing the
+        # positions one by one from the softmax over the remaining arms
+        ranked_positions = _top_k(logits + self._rng.gumbel(size=logits.shape), mask, k)
+
+        return ranked_positions, _gather(np.where(mask, arms_probs, np.nan), ranked_positions)
+
     def _select_idx(
         self,
         arm_indices: List[int],
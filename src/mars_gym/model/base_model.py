@@ -17,11 +17,12 @@ class LogisticRegression(RecommenderModule):
         index_mapping: Dict[str, Dict[Any, int]],
         n_factors: int,
         weight_init: Callable = lecun_normal_init,
+        sparse: bool = False,
     ):
         super().__init__(project_config, index_mapping)
 
-        self.user_embeddings = nn.Embedding(self._n_users, n_factors)
-        self.item_embeddings = nn.Embedding(self._n_items, n_factors)
+        self.user_embeddings = nn.Embedding(self._n_users, n_factors, sparse=sparse)
+        self.item_embeddings = nn.Embedding(self._n_items, n_factors, sparse=sparse)
 
         weight_init(self.user_embeddings.weight)
         weight_init(self.item_embeddings.weight)
@@ -47,4 +48,21 @@ class LogisticRegression(RecommenderModule):
 
         x = torch.cat((user_emb, item_emb), dim=1,)
 
-        return torch.sigmoid(self.linear(x))
+        return torch.sigmoid(self.linear(x)).flatten()
+
+    # The linear layer over the concatenated embeddings is w_u . u + w_i . i + b, the dot product
+    # of [w_u . u + b, 1] and [1, w_i . i]
+    def user_representation(self, user_ids: torch.Tensor) -> torch.Tensor:
+        n_factors = self.user_embeddings.embedding_dim
+        user_bias = F.linear(
+            self.user_embeddings(user_ids), self.linear.weight[:, :n_factors], self.linear.bias
+        )
+        return torch.cat((user_bias, torch.ones_like(user_bias)), dim=1)
+
+    def item_representation(self, item_ids: torch.Tensor) -> torch.Tensor:
+        n_factors = self.user_embeddings.embedding_dim
+        item_bias = F.linear(self.item_embeddings(item_ids), self.linear.weight[:, n_factors:])
+        return torch.cat((torch.ones_like(item_bias), item_bias), dim=1)
+
+    def representation_score(self, dot_products: torch.Tensor) -> torch.Tensor:
+        return torch.sigmoid(dot_products)
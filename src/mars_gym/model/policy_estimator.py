@@ -16,6 +16,7 @@ class PolicyEstimator(RecommenderModule):
         layers: List[int],
         sample_batch: List[torch.Tensor],
         weight_init: Callable = lecun_normal_init,
+        sparse: bool = False,
     ) -> None:
         super().__init__(project_config, index_mapping)
 
@@ -25,7 +26,10 @@ class PolicyEstimator(RecommenderModule):
             if input_column.type in (IOType.INDEXABLE, IOType.INDEXABLE_ARRAY)
         ]
         self.embeddings = nn.ModuleList(
-            [nn.Embedding(n, embedding_dim) for n in num_elements_per_embeddings]
+            [
+                nn.Embedding(n, embedding_dim, sparse=sparse)
+                for n in num_elements_per_embeddings
+            ]
         )
 
         sample_transformed_inputs = self.transform_inputs(sample_batch)
@@ -1,6 +1,6 @@
 import abc
 import os
-from typing import List, Tuple, Union, Type, Any
+from typing import List, Tuple, Union, Type, Any, Optional
 
 import functools
 import gym
@@ -16,6 +16,11 @@ import time
 import pickle
 import gc
 from mars_gym.data.dataset import preprocess_interactions_data_frame
+from mars_gym.data.interaction_log import (
+    InteractionLog,
+    ItemActionCounter,
+    UserItemCounter,
+)
 from mars_gym.model.agent import BanditAgent
 from mars_gym.model.bandit import BanditPolicy
 from mars_gym.simulation.training import (
@@ -24,13 +29,13 @@ from mars_gym.simulation.training import (
 )
 from mars_gym.utils.index_mapping import transform_with_indexing, map_array
 from mars_gym.utils.plot import plot_history, plot_scores
+from mars_gym.utils.sketch import ScoreDistribution
 from mars_gym.utils.reflection import load_attr
 
 tqdm.pandas()
 from mars_gym.gym.envs import RecSysEnv
 from mars_gym.utils.files import (
     get_interaction_dir,
-    get_history_path,
 )
 from mars_gym.utils.files import (
     get_simulator_datalog_path,
@@ -57,8 +62,20 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
     crm_ps_strategy: str = luigi.ChoiceParameter(
         choices=["bandit", "dataset"], default="bandit"
     )
+    # With crm_ps_strategy=dataset, the actions counted for the propensity scores either decay by
+    # crm_ps_decay at each new one or are only the last crm_ps_window ones
+    crm_ps_decay: float = luigi.FloatParameter(default=1.0)
+    crm_ps_window: int = luigi.IntParameter(default=0)
+
+    # The reward model is refit many times during the simulation, so there is nothing to resume
+    checkpoint_every: int = luigi.IntParameter(default=0, significant=False)
+    # Neither it is worth distributing the short trainings of the simulation
+    distributed_world_size: int = luigi.IntParameter(default=1)
 
     obs_batch_size: int = luigi.IntParameter(default=1000)
+    # Observations acted on with a single scoring pass. The history features would be the ones
+    # before the first of them, so it must be 1 for the projects that use them
+    simulation_batch_size: int = luigi.IntParameter(default=1)
     num_episodes: int = luigi.IntParameter(default=1)
     sample_size: int = luigi.IntParameter(default=-1)
     full_refit: bool = luigi.BoolParameter(default=False)
@@ -75,59 +92,61 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         return luigi.LocalTarget(get_interaction_dir(self.__class__, self.task_id))
 
     @property
-    def known_observations_data_frame(self) -> pd.DataFrame:
-        if not hasattr(self, "_known_observations_data_frame"):
+    def compiled_weights_path(self) -> Optional[str]:
+        # The reward model is refit in memory, so it can't be cached with the weights
+        return None
+
+    @property
+    def interaction_log(self) -> InteractionLog:
+        if not hasattr(self, "_interaction_log"):
             columns = self.obs_columns + [
                 self.project_config.item_column.name,
                 self.project_config.output_column.name,
             ]
 
-            self._known_observations_data_frame = pd.DataFrame(columns=columns).astype(
-                self.interactions_data_frame[columns].dtypes
+            self._interaction_log = InteractionLog(
+                dict(self.interactions_data_frame[columns].dtypes)
             )
 
+        return self._interaction_log
+
+    @property
+    def known_observations_data_frame(self) -> pd.DataFrame:
+        # Built from the log only when needed, and kept until the next interaction
+        if not hasattr(self, "_known_observations_data_frame"):
+            self._known_observations_data_frame = self.interaction_log.to_data_frame()
+
         return self._known_observations_data_frame
 
     @property
-    def hist_data_frame(self) -> pd.DataFrame:
-        if not hasattr(self, "_hist_data_frame"):
-            self._hist_data_frame = pd.DataFrame(
-                columns=[
-                    self.project_config.user_column.name,
-                    self.project_config.item_column.name,
-                    self.project_config.hist_view_column_name,
-                    self.project_config.hist_output_column_name,
-                ],
-                dtype=np.int,
-            ).set_index(
-                [
-                    self.project_config.user_column.name,
-                    self.project_config.item_column.name,
-                ]
+    def hist_counter(self) -> UserItemCounter:
+        if not hasattr(self, "_hist_counter"):
+            self._hist_counter = UserItemCounter(n_items=self.n_items)
+        return self._hist_counter
+
+    @property
+    def action_counter(self) -> ItemActionCounter:
+        if not hasattr(self, "_action_counter"):
+            self._action_counter = ItemActionCounter(
+                n_items=self.n_items, decay=self.crm_ps_decay, window=self.crm_ps_window
             )
-        return self._hist_data_frame
+        return self._action_counter
+
+    @property
+    def uses_hist_columns(self) -> bool:
+        hist_columns = (
+            self.project_config.hist_view_column_name,
+            self.project_config.hist_output_column_name,
+        )
+        return any(column.name in hist_columns for column in self.project_config.all_columns)
 
     def _fill_hist_columns(self, ob_df: pd.DataFrame) -> pd.DataFrame:
-        if len(self.known_observations_data_frame) > 0:
-            ob_df = ob_df.drop(
-                columns=[
-                    self.project_config.hist_view_column_name,
-                    self.project_config.hist_output_column_name,
-                ],
-                errors="ignore",
-            )
-            ob_df = ob_df.merge(
-                self.hist_data_frame,
-                how="left",
-                left_on=[
-                    self.project_config.user_column.name,
-                    self.project_config.item_column.name,
-                ],
-                right_index=True,
-            ).fillna(0)
-        else:
-            ob_df[self.project_config.hist_view_column_name] = 0
-            ob_df[self.project_config.hist_output_column_name] = 0
+        views, outputs = self.hist_counter.get(
+            ob_df[self.project_config.user_column.name].values,
+            ob_df[self.project_config.item_column.name].values,
+        )
+        ob_df[self.project_config.hist_view_column_name] = views
+        ob_df[self.project_config.hist_output_column_name] = outputs
         return ob_df
 
     def _accumulate_known_observations(
@@ -136,8 +155,6 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         user_column = self.project_config.user_column.name
         item_column = self.project_config.item_column.name
         output_column = self.project_config.output_column.name
-        hist_view_column = self.project_config.hist_view_column_name
-        hist_output_column = self.project_config.hist_output_column_name
         ps_column = self.project_config.propensity_score_column_name
 
         if self.crm_ps_strategy == "bandit":
@@ -145,27 +162,17 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         else:
             ps_val = self._calulate_propensity_score_with_probs(ob, action)
 
-        new_row = {**ob, item_column: action, output_column: reward, ps_column: ps_val}
-        
-        self._known_observations_data_frame = self.known_observations_data_frame.append(
-            new_row, ignore_index=True
+        self.interaction_log.append(
+            {**ob, item_column: action, output_column: reward, ps_column: ps_val}
         )
+        if hasattr(self, "_known_observations_data_frame"):
+            del self._known_observations_data_frame
 
-        user_index = ob[user_column]
-        if (user_index, action) not in self.hist_data_frame.index:
-            self.hist_data_frame.loc[(user_index, action), hist_view_column] = 1
-            self.hist_data_frame.loc[(user_index, action), hist_output_column] = int(
-                reward
-            )
-        else:
-            self.hist_data_frame.loc[(user_index, action), hist_view_column] += 1
-            self.hist_data_frame.loc[(user_index, action), hist_output_column] += int(
-                reward
-            )
+        self.hist_counter.add(ob[user_column], action, int(reward))
+        if self.crm_ps_strategy == "dataset":
+            self.action_counter.add(action)
 
     def _calulate_propensity_score(self, ob: dict, prob: float) -> float:
-        df = self.known_observations_data_frame
-
         if self.project_config.available_arms_column_name is None:
             n = 1
         else:
@@ -175,15 +182,7 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         return ps
 
     def _calulate_propensity_score_with_probs(self, ob: dict, action: int):
-        df = self.known_observations_data_frame
-        try:
-            prob = self._known_observations_data_frame.item_idx.value_counts(
-                normalize=True
-            )[action]
-        except IndexError:
-            prob = 0
-        except KeyError:
-            prob = 0
+        prob = float(self.action_counter.probs(action))
 
         n = len(ob[self.project_config.available_arms_column_name])
         prob += 0.001  # error
@@ -271,14 +270,18 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         )
 
     def _save_trial_log(self, i, trial) -> None:
+        if self.diagnostics == "off":
+            return
+
         os.makedirs(os.path.join(self.output().path, "plot_history"), exist_ok=True)
 
         if trial:
-            history_df = pd.read_csv(get_history_path(self.output().path))
-            plot_history(history_df).savefig(
+            self.plotter.submit(
                 os.path.join(
                     self.output().path, "plot_history", "history_{}.jpg".format(i)
-                )
+                ),
+                plot_history,
+                pd.DataFrame(trial.state[torchbearer.HISTORY]),
             )
             self._save_score_log(i, trial)
 
@@ -304,10 +307,16 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         scores_tensor: torch.Tensor = model_output if isinstance(
             model_output, torch.Tensor
         ) else model_output[0][0]
-        scores: List[float] = scores_tensor.cpu().numpy().reshape(-1).tolist()
+        distribution = ScoreDistribution()
+        distribution.update(scores_tensor.cpu().numpy())
 
-        plot_scores(scores).savefig(
-            os.path.join(self.output().path, "plot_history", "scores_{}.jpg".format(i))
+        distribution.save(
+            os.path.join(self.output().path, "plot_history", "scores_{}.json".format(i))
+        )
+        self.plotter.submit(
+            os.path.join(self.output().path, "plot_history", "scores_{}.jpg".format(i)),
+            plot_scores,
+            distribution,
         )
 
     def get_data_frame_for_indexing(self) -> pd.DataFrame:
@@ -316,12 +325,16 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
     @property
     def interactions_data_frame(self) -> pd.DataFrame:
         if not hasattr(self, "_interactions_data_frame"):
-            data = pd.concat(
-                [
-                    pd.read_csv(self.train_data_frame_path),
-                    pd.read_csv(self.val_data_frame_path),
-                ],
-                ignore_index=True,
+            data = self._cached_data_frame(
+                [self.train_data_frame_path, self.val_data_frame_path],
+                "all_interactions",
+                lambda: pd.concat(
+                    [
+                        pd.read_csv(self.train_data_frame_path),
+                        pd.read_csv(self.val_data_frame_path),
+                    ],
+                    ignore_index=True,
+                ),
             )
             if self.sample_size > 0:
                 data = data[-self.sample_size :]
@@ -389,6 +402,9 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         if hasattr(self, "_interactions_data_frame"):
             del self._interactions_data_frame
 
+        if hasattr(self, "_interaction_log"):
+            del self._interaction_log
+
         if hasattr(self, "_known_observations_data_frame"):
             del self._known_observations_data_frame
 
@@ -446,9 +462,21 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         print(stats[["count", "mean", "std"]], "\n")
 
     def run(self):
+        if self.checkpoint_every > 0:
+            raise ValueError("The interaction training can't be checkpointed")
+        if self.distributed_world_size > 1:
+            raise ValueError("The interaction training can't be distributed")
+        if self.simulation_batch_size > 1 and self.uses_hist_columns:
+            raise ValueError(
+                "The history features change within a simulation batch, "
+                "so simulation_batch_size must be 1 for this project"
+            )
+
         os.makedirs(self.output().path, exist_ok=True)
         self.start_time = time.time()
 
+        self.seed_everything()
+
         self._save_params()
         print("DataFrame: env_data_frame, ", self.env_data_frame.shape)
         print("DataFrame: interactions_data_frame, ", self.interactions_data_frame.shape)
@@ -475,24 +503,27 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
             ob = self.env.reset()
 
             while True:
-                interactions += 1
-
-                # TODO
-                if self.project_config.available_arms_column_name in ob:
-                    # The Env returns a binary array to be compatible with OpenAI Gym API but the actual items are needed
-                    ob[self.project_config.available_arms_column_name] = [
-                        self.reverse_index_mapping[self.project_config.item_column.name][index]
-                        for index in np.flatnonzero(
+                # Until the next refit, the observations don't depend on the actions, so up to
+                # simulation_batch_size of them are scored together, and then stepped in order
+                batch_size = min(
+                    self.simulation_batch_size,
+                    self.obs_batch_size - interactions % self.obs_batch_size,
+                )
+                obs = [ob] + self.env.peek(batch_size - 1)
+
+                for ob in obs:
+                    if self.project_config.available_arms_column_name in ob:
+                        # The Env returns the indices of the available items, but the actual items are needed
+                        ob[self.project_config.available_arms_column_name] = self.item_index_values[
                             ob[self.project_config.available_arms_column_name]
-                        ).tolist()
-                    ]
+                        ].tolist()
 
-                
-                action, prob = self._act(self.agent, ob)
+                for ob, (action, prob) in zip(obs, self._act_batch(self.agent, obs)):
+                    interactions += 1
 
-                new_ob, reward, done, info = self.env.step(action)
-                rewards.append(reward)
-                self._accumulate_known_observations(ob, action, prob, reward)
+                    new_ob, reward, done, info = self.env.step(action)
+                    rewards.append(reward)
+                    self._accumulate_known_observations(ob, action, prob, reward)
 
                 if done:
                     break
@@ -527,3 +558,4 @@ class InteractionTraining(SupervisedModelTraining, metaclass=abc.ABCMeta):
         self.end_time = time.time()
         # Save logs
         self._save_result()
+        self.plotter.wait()
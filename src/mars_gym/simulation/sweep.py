@@ -0,0 +1,281 @@
+import gc
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
+from copy import deepcopy
+from multiprocessing.connection import wait
+from typing import Any, Dict, List, Type
+
+import luigi
+import numpy as np
+import pandas as pd
+import torch
+
+from mars_gym.simulation.interaction import InteractionTraining
+from mars_gym.simulation.training import _BaseModelTraining, TorchModelTraining
+from mars_gym.utils.files import (
+    get_history_path,
+    get_index_mapping_path,
+    get_task_dir,
+)
+from mars_gym.utils.reflection import load_attr
+
+# Attributes loaded once by the sweep and inherited (copy-on-write) by every forked worker
+SHARED_DATA_ATTRS = [
+    "_index_mapping",
+    "_train_data_frame",
+    "_val_data_frame",
+    "_test_data_frame",
+    "_metadata_data_frame",
+    "_embeddings_for_metadata",
+]
+
+
+def _run_trial(
+    task: TorchModelTraining, shared_data: Dict[str, Any], threads_per_worker: int
+) -> None:
+    torch.set_num_threads(threads_per_worker)
+
+    for attr, value in shared_data.items():
+        setattr(task, attr, value)
+
+    try:
+        os.makedirs(task.output().path, exist_ok=True)
+        with open(get_index_mapping_path(task.output().path), "wb") as f:
+            pickle.dump(task.index_mapping, f)
+
+        task.run()
+    except BaseException:
+        shutil.rmtree(task.output().path, ignore_errors=True)
+        raise
+
+
+class HyperparameterSweep(luigi.Task):
+    model_task_class: str = luigi.Parameter(
+        default="mars_gym.simulation.training.SupervisedModelTraining"
+    )
+    model_task_params: Dict[str, Any] = luigi.DictParameter(
+        default={},
+        description="Parameters shared by every trial, like the ones passed to the model task",
+    )
+    grid: Dict[str, List[Any]] = luigi.DictParameter(
+        description="Values to be combined, like "
+        '{"learning_rate": [0.001, 0.01], "recommender_extra_params.n_factors": [10, 50]}',
+    )
+    num_workers: int = luigi.IntParameter(default=None, significant=False)
+    threads_per_worker: int = luigi.IntParameter(default=1, significant=False)
+    successive_halving: bool = luigi.BoolParameter(default=False)
+    halving_eta: int = luigi.IntParameter(default=3)
+    halving_min_epochs: int = luigi.IntParameter(default=1)
+
+    @property
+    def task_class(self) -> Type[TorchModelTraining]:
+        if not hasattr(self, "_task_class"):
+            self._task_class = load_attr(self.model_task_class, Type[TorchModelTraining])
+            if issubclass(self._task_class, InteractionTraining):
+                raise ValueError(
+                    "The sweep only supports offline trainings, not {}".format(
+                        self.model_task_class
+                    )
+                )
+        return self._task_class
+
+    @property
+    def base_params(self) -> Dict[str, Any]:
+        return json.loads(json.dumps(self.model_task_params, default=lambda o: dict(o)))
+
+    @property
+    def base_task(self) -> TorchModelTraining:
+        return self.task_class(**self.base_params)
+
+    @property
+    def configs(self) -> List[Dict[str, Any]]:
+        data_params = set(_BaseModelTraining.get_param_names())
+        param_names = set(self.task_class.get_param_names())
+        for key in self.grid.keys():
+            name = key.split(".")[0]
+            if name not in param_names:
+                raise ValueError("Unknown parameter in the grid: {}".format(key))
+            if name in data_params:
+                raise ValueError(
+                    "The data is shared by all trials, so {} can't be part of the grid".format(key)
+                )
+
+        keys = sorted(self.grid.keys())
+        return [
+            dict(zip(keys, values))
+            for values in itertools.product(*[list(self.grid[key]) for key in keys])
+        ]
+
+    def requires(self):
+        return self.base_task.prepare_data_frames
+
+    def output(self):
+        return luigi.LocalTarget(
+            os.path.join(get_task_dir(self.__class__, self.task_id), "results.csv")
+        )
+
+    def create_trial_task(self, config: Dict[str, Any], **extra_params) -> TorchModelTraining:
+        params = deepcopy(self.base_params)
+        for key, value in config.items():
+            *parents, name = key.split(".")
+            target = params
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        params.update(extra_params)
+        return self.task_class(**params)
+
+    @property
+    def shared_data(self) -> Dict[str, Any]:
+        if not hasattr(self, "_shared_data"):
+            print("Loading the shared data...")
+            task = self.base_task
+
+            # The index mapping is written to the task dir, which must not be left behind
+            # or the base task would be considered complete
+            created_dir = not os.path.exists(task.output().path)
+            os.makedirs(task.output().path, exist_ok=True)
+            try:
+                for attr in SHARED_DATA_ATTRS:
+                    getattr(task, attr[1:])
+                self._shared_data = {attr: getattr(task, attr) for attr in SHARED_DATA_ATTRS}
+            finally:
+                if created_dir:
+                    shutil.rmtree(task.output().path)
+            gc.collect()
+        return self._shared_data
+
+    def _best_metric(self, task: TorchModelTraining) -> float:
+        history_path = get_history_path(task.output().path)
+        if not os.path.exists(history_path):
+            return np.nan
+        history_df = pd.read_csv(history_path)
+        if task.monitor_metric not in history_df.columns or len(history_df) == 0:
+            return np.nan
+        if task.monitor_mode == "max":
+            return history_df[task.monitor_metric].max()
+        return history_df[task.monitor_metric].min()
+
+    def _run_rung(self, tasks: List[TorchModelTraining]) -> Dict[str, str]:
+        status = {}
+        pending = []
+        for task in tasks:
+            if task.complete():
+                status[task.task_id] = "done"
+            else:
+                pending.append(task)
+
+        if not pending:
+            return status
+
+        shared_data = self.shared_data
+        num_workers = self.num_workers or max(
+            1, (os.cpu_count() or 1) // self.threads_per_worker
+        )
+        # A forked child can't use CUDA once the parent has initialized it, so the workers are
+        # spawned instead, getting a pickled copy of the shared data
+        context = multiprocessing.get_context(
+            "fork" if tasks[0].device == "cpu" else "spawn"
+        )
+
+        running = {}
+        while pending or running:
+            while pending and len(running) < num_workers:
+                task = pending.pop(0)
+                process = context.Process(
+                    target=_run_trial,
+                    args=(task, shared_data, self.threads_per_worker),
+                    name=task.task_id,
+                )
+                process.start()
+                running[process.sentinel] = (process, task)
+
+            for sentinel in wait(list(running.keys())):
+                process, task = running.pop(sentinel)
+                process.join()
+                status[task.task_id] = "done" if process.exitcode == 0 else "failed"
+                print("Trial {}: {}".format(task.task_id, status[task.task_id]))
+
+        return status
+
+    def _rank(self, results: List[Dict[str, Any]], mode: str) -> List[Dict[str, Any]]:
+        sign = -1 if mode == "max" else 1
+        return sorted(
+            results,
+            key=lambda r: (
+                math.isnan(r["best_metric"]),
+                sign * r["best_metric"] if not math.isnan(r["best_metric"]) else 0,
+            ),
+        )
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.output().path), exist_ok=True)
+
+        base_task = self.base_task
+        max_epochs = base_task.epochs
+        configs = self.configs
+        results = []
+
+        rung = 0
+        epochs = self.halving_min_epochs
+        while True:
+            final = (
+                not self.successive_halving or len(configs) <= 1 or epochs >= max_epochs
+            )
+            rung_epochs = max_epochs if final else epochs
+            # The trials keep the same task_id in every rung, so the promoted ones are resumed
+            # from the checkpoint of the epoch they were paused at
+            extra_params = {"checkpoint_every": 1, "resume": True}
+            if not final:
+                extra_params["pause_after_epochs"] = rung_epochs
+
+            print(
+                "Sweep rung {}: {} trials with {} epochs".format(
+                    rung, len(configs), rung_epochs
+                )
+            )
+            tasks = [self.create_trial_task(config, **extra_params) for config in configs]
+            status = self._run_rung(tasks)
+
+            rung_results = [
+                {
+                    "task_id": task.task_id,
+                    "rung": rung,
+                    "epochs": rung_epochs,
+                    **config,
+                    "status": status[task.task_id],
+                    "best_metric": self._best_metric(task),
+                    "config": config,
+                }
+                for config, task in zip(configs, tasks)
+            ]
+            results.extend(rung_results)
+
+            if final:
+                break
+
+            ranked = self._rank(rung_results, base_task.monitor_mode)
+            configs = [
+                r["config"] for r in ranked[: max(1, len(ranked) // self.halving_eta)]
+            ]
+            epochs *= self.halving_eta
+            rung += 1
+
+        df = pd.DataFrame(
+            [{k: v for k, v in r.items() if k != "config"} for r in results]
+        )
+        df = df.rename(columns={"best_metric": base_task.monitor_metric})
+        df = df.sort_values(
+            ["rung", base_task.monitor_metric],
+            ascending=[False, base_task.monitor_mode != "max"],
+        )
+
+        print(df.to_string(index=False))
+
+        with self.output().temporary_path() as path:
+            df.to_csv(path, index=False)
@@ -1,26 +1,34 @@
 import abc
 import functools
 import gc
+import itertools
+import io
+import multiprocessing
 import json
 import logging
 import os
 import pickle
 import random
+import shlex
 import shutil
-from contextlib import redirect_stdout
+import sys
+from contextlib import nullcontext, redirect_stdout
 from copy import deepcopy
 from multiprocessing import Pool
 from typing import Type, Dict, List, Optional, Tuple, Union, Any, cast
 import math
 import luigi
+from luigi.cmdline_parser import CmdlineParser
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchbearer
 from torch.nn.init import xavier_normal
-from torch.optim import Adam, RMSprop, SGD
+from torch.optim import Adam, RMSprop, SGD, SparseAdam
 from torch.optim.adadelta import Adadelta
 from torch.optim.adagrad import Adagrad
 from torch.optim.adamax import Adamax
@@ -29,18 +37,12 @@ from torch.utils.data import DataLoader
 from torch.utils.data._utils.collate import default_convert
 from torch.utils.data.dataset import Dataset, ChainDataset
 from torchbearer import Trial
-from torchbearer.callbacks import GradientNormClipping
+from torchbearer.callbacks import Callback, GradientNormClipping
 from torchbearer.callbacks.checkpointers import ModelCheckpoint
 from torchbearer.callbacks.csv_logger import CSVLogger
 from torchbearer.callbacks.early_stopping import EarlyStopping
 from torchbearer.callbacks.tensor_board import TensorBoard
 from tqdm import tqdm
-import matplotlib
-
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import seaborn as sns
-
 import mars_gym
 from mars_gym.cuda import CudaRepository
 from mars_gym.data.dataset import (
@@ -49,30 +51,69 @@ from mars_gym.data.dataset import (
     literal_eval_array_columns,
     InteractionsDataset,
 )
+from mars_gym.data.cache import (
+    cached_data_frame,
+    data_frame_cache_key,
+    index_mapping_hash,
+    project_config_fingerprint,
+)
 from mars_gym.gym.envs.recsys import ITEM_METADATA_KEY
 from mars_gym.meta_config import Column, IOType, ProjectConfig
 from mars_gym.model.abstract import RecommenderModule
 from mars_gym.model.agent import BanditAgent
 from mars_gym.model.bandit import BanditPolicy
-from mars_gym.torch.data import NoAutoCollationDataLoader, FasterBatchSampler
+from mars_gym.torch.callbacks import (
+    AutocastCallback,
+    DistributedSync,
+    FullStateCheckpoint,
+    ThroughputMonitor,
+    get_checkpoint_epoch,
+    list_checkpoints,
+    load_latest_checkpoint,
+    set_rng_states,
+)
+from mars_gym.torch.data import (
+    NoAutoCollationDataLoader,
+    FasterBatchSampler,
+    DistributedFasterBatchSampler,
+)
+from mars_gym.torch.distributed import (
+    DistributedModule,
+    find_free_port,
+    get_rank,
+    get_world_size,
+    init_local_process_group,
+    strip_distributed_prefix,
+)
+from mars_gym.torch.inference import INFERENCE_MODES, get_recommendation_score_function
 from mars_gym.torch.init import lecun_normal_init, he_init
 from mars_gym.torch.loss import (
     ImplicitFeedbackBCELoss,
     CounterfactualRiskMinimization,
     FocalLoss,DummyLoss
 )
-from mars_gym.torch.optimizer import RAdam
+from mars_gym.torch.optimizer import (
+    RAdam,
+    LazyAdam,
+    MultipleOptimizer,
+    split_sparse_parameters,
+)
+from mars_gym.torch.retrieval import top_k_by_dot_product
 from mars_gym.torch.summary import summary
 from mars_gym.utils.files import (
     get_params_path,
     get_weights_path,
+    get_compiled_weights_path,
+    get_checkpoints_dir,
     get_interaction_dir,
     get_params,
     get_history_path,
     get_tensorboard_logdir,
     get_task_dir,
     get_test_set_predictions_path,
+    get_test_set_predictions_progress_path,
     get_index_mapping_path,
+    get_data_frame_cache_path,
 )
 from mars_gym.utils.index_mapping import (
     create_index_mapping,
@@ -80,9 +121,11 @@ from mars_gym.utils.index_mapping import (
     transform_with_indexing,
     map_array,
 )
-from mars_gym.utils.plot import plot_history
+from mars_gym.utils.plot import BackgroundPlotter, plot_history, plot_scores
 from mars_gym.utils import files
 from mars_gym.utils.reflection import load_attr
+from mars_gym.utils.sketch import ScoreDistribution
+from mars_gym.utils.utils import pad_sequences, read_csv_dtypes, read_csv_rows
 
 logging.basicConfig(
     format="%(asctime)s : %(levelname)s : %(message)s", level=logging.INFO
@@ -96,7 +139,18 @@ TORCH_OPTIMIZERS = dict(
     adagrad=Adagrad,
     adamax=Adamax,
     radam=RAdam,
+    lazy_adam=LazyAdam,
 )
+# Optimizers for the embeddings with sparse gradients
+TORCH_SPARSE_OPTIMIZERS = dict(sparse_adam=SparseAdam, lazy_adam=LazyAdam,)
+# off: no diagnostics, light: statistics of a sample of the data, full: statistics of all of it
+DIAGNOSTICS_LEVELS = ["off", "light", "full"]
+# Distribution of the negative items sampled as candidate arms when there are no available arms
+CANDIDATE_SAMPLINGS = ["uniform", "popularity"]
+# Random keys drawn at once to sample the candidate arms, which bounds their memory
+CANDIDATE_KEYS_PER_BATCH = 2 ** 22
+# parquet: a directory with a part file per chunk, with typed list columns, csv: stringified lists
+PREDICTIONS_FORMATS = ["parquet", "csv"]
 TORCH_LOSS_FUNCTIONS = dict(
     mse=nn.MSELoss,
     nll=nn.NLLLoss,
@@ -116,6 +170,7 @@ TORCH_WEIGHT_INIT = dict(
     lecun_normal=lecun_normal_init, he=he_init, xavier_normal=xavier_normal
 )
 TORCH_DROPOUT_MODULES = dict(dropout=nn.Dropout, alpha=nn.AlphaDropout)
+TORCH_PRECISIONS = dict(float32=torch.float32, bfloat16=torch.bfloat16)
 
 SEED = 42
 
@@ -156,6 +211,9 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
     seed: int = luigi.IntParameter(default=SEED)
     observation: str = luigi.Parameter(default="")
     load_index_mapping_path: str = luigi.Parameter(default=None)
+    cache_data_frames: bool = luigi.BoolParameter(
+        default=True, significant=False, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
 
     negative_proportion: int = luigi.FloatParameter(0.0)
 
@@ -169,6 +227,10 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
             "_val_data_frame",
             "_train_data_frame",
             "_metadata_data_frame",
+            "_recommendation_score_function",
+            "_trained_module",
+            "_test_set_predictions",
+            "_trained_pairs",
         ]
 
     def requires(self):
@@ -279,20 +341,53 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
     def dataset_read_columns(self) -> List[str]:
         except_columns = [self.project_config.propensity_score_column_name, *[c.name for c in self.project_config.metadata_columns]]
         columns        = [c.name for c in self.project_config.all_columns if c.name not in except_columns]
-        columns        += [self.project_config.available_arms_column_name]
+        if self.project_config.available_arms_column_name:
+            columns    += [self.project_config.available_arms_column_name]
         return columns
 
+    @property
+    def index_mapping_hash(self) -> str:
+        if not hasattr(self, "_index_mapping_hash"):
+            self._index_mapping_hash = index_mapping_hash(self.index_mapping)
+        return self._index_mapping_hash
+
+    def _cached_data_frame(
+        self, paths: List[str], data_key: str, build_fn, **extra_params
+    ) -> pd.DataFrame:
+        if not self.cache_data_frames:
+            return build_fn()
+
+        cache_key = data_frame_cache_key(
+            paths,
+            data_key=data_key,
+            read_columns=self.dataset_read_columns,
+            project_config=project_config_fingerprint(self.project_config),
+            **extra_params,
+        )
+        return cached_data_frame(get_data_frame_cache_path(cache_key), build_fn)
+
+    def _read_encoded_data_frame(self, path: str, data_key: str) -> pd.DataFrame:
+        def build_data_frame() -> pd.DataFrame:
+            df = preprocess_interactions_data_frame(
+                pd.read_csv(path, usecols=self.dataset_read_columns),
+                self.project_config,
+            )
+            transform_with_indexing(df, self.index_mapping, self.project_config)
+            return df
+
+        return self._cached_data_frame(
+            [path],
+            data_key,
+            build_data_frame,
+            index_mapping_hash=self.index_mapping_hash,
+        )
+
     @property
     def train_data_frame(self) -> pd.DataFrame:
         if not hasattr(self, "_train_data_frame"):
             print("train_data_frame:")
-            self._train_data_frame = preprocess_interactions_data_frame(
-                pd.read_csv(self.train_data_frame_path, 
-                    usecols = self.dataset_read_columns), self.project_config
-            )
-        
-            transform_with_indexing(
-                self._train_data_frame, self.index_mapping, self.project_config
+            self._train_data_frame = self._read_encoded_data_frame(
+                self.train_data_frame_path, TRAIN_DATA
             )
 
         return self._train_data_frame
@@ -301,13 +396,8 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
     def val_data_frame(self) -> pd.DataFrame:
         if not hasattr(self, "_val_data_frame"):
             print("val_data_frame:")
-            self._val_data_frame = preprocess_interactions_data_frame(
-                pd.read_csv(self.val_data_frame_path, 
-                    usecols = self.dataset_read_columns), self.project_config
-            )
-
-            transform_with_indexing(
-                self._val_data_frame, self.index_mapping, self.project_config
+            self._val_data_frame = self._read_encoded_data_frame(
+                self.val_data_frame_path, VAL_DATA
             )
 
         return self._val_data_frame
@@ -316,28 +406,27 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
     def test_data_frame(self) -> pd.DataFrame:
         if not hasattr(self, "_test_data_frame"):
             print("test_data_frame:")
-            self._test_data_frame = preprocess_interactions_data_frame(
-                pd.read_csv(self.test_data_frame_path, 
-                    usecols = self.dataset_read_columns), self.project_config
-            )
-
-            transform_with_indexing(
-                self._test_data_frame, self.index_mapping, self.project_config
+            self._test_data_frame = self._read_encoded_data_frame(
+                self.test_data_frame_path, TEST_DATA
             )
 
         return self._test_data_frame
 
     def get_data_frame_for_indexing(self) -> pd.DataFrame:
-        return pd.concat([pd.read_csv(self.train_data_frame_path, 
-                                usecols = self.dataset_read_columns), 
-                         pd.read_csv(self.val_data_frame_path, 
-                                usecols = self.dataset_read_columns)]).drop_duplicates()
+        return self.get_data_frame_interactions()
 
     def get_data_frame_interactions(self) ->  pd.DataFrame:
-        return pd.concat([pd.read_csv(self.train_data_frame_path, 
-                                usecols = self.dataset_read_columns), 
-                         pd.read_csv(self.val_data_frame_path, 
-                                usecols = self.dataset_read_columns)]).drop_duplicates()
+        def build_data_frame() -> pd.DataFrame:
+            return pd.concat([pd.read_csv(self.train_data_frame_path, 
+                                    usecols = self.dataset_read_columns), 
+                             pd.read_csv(self.val_data_frame_path, 
+                                    usecols = self.dataset_read_columns)]).drop_duplicates()
+
+        return self._cached_data_frame(
+            [self.train_data_frame_path, self.val_data_frame_path],
+            "interactions",
+            build_data_frame,
+        )
 
     @property
     def index_mapping_path(self) -> Optional[str]:
@@ -351,9 +440,6 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
             print("index_mapping...")
             
             self._creating_index_mapping = True
-            df = preprocess_interactions_data_frame(
-                    self.get_data_frame_for_indexing(), self.project_config
-                )
 
             if os.path.exists(self.index_mapping_path):
                 with open(self.index_mapping_path, "rb") as f:
@@ -365,6 +451,18 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
             keys_in_map = list(self._index_mapping.keys())
             project_all_columns = [c for c in self.project_config.all_columns if c.name not in keys_in_map]
 
+            # Only read the data frames when there are columns left to be indexed
+            if any(
+                column.type in (IOType.INDEXABLE, IOType.INDEXABLE_ARRAY)
+                and not column.same_index_as
+                for column in project_all_columns
+            ):
+                df = preprocess_interactions_data_frame(
+                        self.get_data_frame_for_indexing(), self.project_config
+                    )
+            else:
+                df = None
+
             print("indexing project_all_columns...")
             for column in project_all_columns:
                 if column.type == IOType.INDEXABLE and not column.same_index_as:
@@ -501,6 +599,10 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
     def before_run(self):
         self.index_mapping
 
+    @property
+    def has_checkpoints(self) -> bool:
+        return False
+
     def run(self):
         os.makedirs(self.output().path, exist_ok=True)
 
@@ -511,7 +613,9 @@ class _BaseModelTraining(luigi.Task, metaclass=abc.ABCMeta):
         try:
             self.train()
         except Exception:
-            shutil.rmtree(self.output().path)
+            # The checkpoints are kept, so the training can be resumed
+            if not self.has_checkpoints:
+                shutil.rmtree(self.output().path)
             raise
         finally:
             gc.collect()
@@ -527,6 +631,40 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
     recommender_extra_params: Dict[str, Any] = luigi.DictParameter(default={})
 
     device: str = luigi.ChoiceParameter(choices=["cpu", "cuda"], default=DEFAULT_DEVICE)
+    precision: str = luigi.ChoiceParameter(
+        choices=TORCH_PRECISIONS.keys(), default="float32"
+    )
+    inference_mode: str = luigi.ChoiceParameter(
+        choices=INFERENCE_MODES, default="eager", significant=False
+    )
+    monitor_throughput: bool = luigi.BoolParameter(
+        default=True, significant=False, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
+    checkpoint_every: int = luigi.IntParameter(default=1, significant=False)
+    checkpoint_keep_last: int = luigi.IntParameter(default=2, significant=False)
+    resume: bool = luigi.BoolParameter(default=False, significant=False)
+    pause_after_epochs: int = luigi.IntParameter(
+        default=None,
+        significant=False,
+        description="Stops the training after these epochs, without finishing the task, "
+        "so it can be resumed later from its checkpoints",
+    )
+    abort_on_interrupt: bool = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="On Ctrl-C, saves a checkpoint and aborts the task, so it can be resumed, "
+        "instead of finishing the training and evaluating the model",
+    )
+    distributed_world_size: int = luigi.IntParameter(
+        default=1,
+        description="Number of local processes training the model with DistributedDataParallel. "
+        "The batch_size is split between them",
+    )
+    distributed_threads_per_rank: int = luigi.IntParameter(default=None, significant=False)
+    diagnostics: str = luigi.ChoiceParameter(
+        choices=DIAGNOSTICS_LEVELS, default="light", significant=False
+    )
+    diagnostics_sample_size: int = luigi.IntParameter(default=10000, significant=False)
 
     batch_size: int = luigi.IntParameter(default=500)
     epochs: int = luigi.IntParameter(default=100)
@@ -534,6 +672,10 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
         choices=TORCH_OPTIMIZERS.keys(), default="adam"
     )
     optimizer_params: dict = luigi.DictParameter(default={})
+    sparse_optimizer: str = luigi.ChoiceParameter(
+        choices=TORCH_SPARSE_OPTIMIZERS.keys(), default="sparse_adam"
+    )
+    sparse_optimizer_params: dict = luigi.DictParameter(default={})
     learning_rate: float = luigi.FloatParameter(1e-3)
     loss_function: str = luigi.ChoiceParameter(
         choices=TORCH_LOSS_FUNCTIONS.keys(), default="bce"
@@ -552,6 +694,9 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
     run_evaluate_extra_params: str = luigi.Parameter(default=" --only-new-interactions --only-exist-items", significant=False)
 
     sample_size_eval: int = luigi.IntParameter(default=None)
+    prediction_chunk_size: int = luigi.IntParameter(default=10000, significant=False)
+    predictions_format: str = luigi.ChoiceParameter(choices=PREDICTIONS_FORMATS, default="parquet", significant=False)
+    predictions_top_k: int = luigi.IntParameter(default=None)
 
     metrics = luigi.ListParameter(default=["loss"])
 
@@ -559,6 +704,44 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
     def resources(self):
         return {"cuda": 1} if self.device == "cuda" else {}
 
+    @property
+    def checkpoints_dir(self) -> str:
+        return get_checkpoints_dir(self.output().path)
+
+    @property
+    def has_checkpoints(self) -> bool:
+        return len(list_checkpoints(self.checkpoints_dir)) > 0
+
+    @property
+    def completed_path(self) -> str:
+        return os.path.join(self.checkpoints_dir, "COMPLETED")
+
+    def complete(self):
+        # A task dir with checkpoints of an unfinished training can still be resumed
+        if os.path.isdir(self.checkpoints_dir) and not os.path.exists(
+            self.completed_path
+        ):
+            return False
+        return super().complete()
+
+    def _load_checkpoint(self) -> Optional[Dict[str, Any]]:
+        if not self.resume:
+            shutil.rmtree(self.checkpoints_dir, ignore_errors=True)
+            return None
+
+        checkpoint = load_latest_checkpoint(self.checkpoints_dir)
+        if checkpoint is None:
+            return None
+
+        # Drop the epochs logged after the checkpoint, which will be trained again
+        history_path = get_history_path(self.output().path)
+        if os.path.exists(history_path):
+            history_df = pd.read_csv(history_path)
+            history_df[history_df["epoch"] < checkpoint["epoch"]].to_csv(
+                history_path, index=False
+            )
+        return checkpoint
+
     @property
     def device_id(self):
         if not hasattr(self, "_device_id"):
@@ -592,41 +775,175 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
         if self.device == "cuda":
             torch.cuda.set_device(self.device_id)
 
-        train_loader = self.get_train_generator()
-        val_loader = self.get_val_generator()
         module = self.create_module()
 
-        print("train_data_frame:")
-        print(self.train_data_frame.describe())
-        
-        summary_path = os.path.join(self.output().path, "summary.txt")
-        with open(summary_path, "w") as summary_file:
-            with redirect_stdout(summary_file):
-                sample_input = self.get_sample_batch()
-                summary(module, sample_input)
-            summary(module, sample_input)
-
-        sample_data = self.train_data_frame.sample(100, replace=True)
+        self.save_data_diagnostics()
+        if self.diagnostics != "off":
+            self.save_module_summary(module)
+
+        if self.pause_after_epochs and self.checkpoint_every <= 0:
+            raise ValueError("The training can only be paused with checkpoint_every > 0")
+
+        self._checkpoint = self._load_checkpoint()
+        if self.distributed_world_size > 1:
+            history = self._fit_distributed(module)
+        else:
+            history = self._fit(module)
+        del self._checkpoint
+
+        if self._is_paused(history):
+            print("Pausing the training after {} epochs...".format(len(history)))
+            return
+
+        if self.diagnostics != "off":
+            self.plotter.submit(
+                os.path.join(self.output().path, "history.jpg"),
+                plot_history,
+                pd.DataFrame(history),
+            )
+
+        self.after_fit()
+        self.evaluate()
+        self.cache_cleanup()
+        self.plotter.wait()
+
+        if os.path.isdir(self.checkpoints_dir):
+            open(self.completed_path, "w").close()
+
+    @property
+    def plotter(self) -> BackgroundPlotter:
+        if not hasattr(self, "_plotter"):
+            self._plotter = BackgroundPlotter()
+        return self._plotter
+
+    def save_data_diagnostics(self):
+        if self.diagnostics == "off":
+            return
+
+        df = self.train_data_frame
+        if self.diagnostics == "light" and len(df) > self.diagnostics_sample_size:
+            df = df.sample(self.diagnostics_sample_size, random_state=self.seed)
+            print("train_data_frame (sample of {} rows):".format(len(df)))
+        else:
+            print("train_data_frame:")
+        print(df.describe())
+
+        # A local random state, so the diagnostics don't change the training
+        sample_data = self.train_data_frame.sample(100, replace=True, random_state=self.seed)
         sample_data.to_csv(os.path.join(self.output().path, "sample_train.csv"))
-        
+
+    def save_module_summary(self, module: nn.Module):
+        summary_buffer = io.StringIO()
+        with redirect_stdout(summary_buffer):
+            summary(module, self.get_sample_batch())
+        with open(os.path.join(self.output().path, "summary.txt"), "w") as summary_file:
+            summary_file.write(summary_buffer.getvalue())
+        print(summary_buffer.getvalue(), end="")
+
+    def _fit(self, module: nn.Module) -> List[Dict[str, Any]]:
+        train_loader = self.get_train_generator()
+        val_loader = self.get_val_generator()
+
         trial = self.create_trial(module)
+        stopped = False
+        if self._checkpoint is not None:
+            print("Resuming the training from epoch {}...".format(self._checkpoint["epoch"]))
+            trial_state = self._checkpoint["trial"]
+            if not self.is_main_rank:
+                # Only the main rank has the logging and checkpointing callbacks
+                trial_state = {
+                    k: v for k, v in trial_state.items() if k != torchbearer.CALLBACK_LIST
+                }
+            trial.load_state_dict(trial_state)
+            set_rng_states(self._checkpoint["rng_states"])
+            stopped = self._checkpoint["stop_training"]
 
         try:
-            trial.with_generators(
-                train_generator=train_loader, val_generator=val_loader
-            ).run(epochs=self.epochs)
+            if not stopped:
+                trial.with_generators(
+                    train_generator=train_loader, val_generator=val_loader
+                ).run(epochs=min(self.epochs, self.pause_after_epochs or self.epochs))
         except KeyboardInterrupt:
+            if self.abort_on_interrupt:
+                self._save_last_checkpoint(trial)
+                raise
             print("Finishing the training at the request of the user...")
 
-        history_df = pd.read_csv(get_history_path(self.output().path))
-
-        plot_history(history_df).savefig(
-            os.path.join(self.output().path, "history.jpg")
+        history = trial.state[torchbearer.HISTORY]
+        if self._is_paused(history):
+            self._save_last_checkpoint(trial)
+        return history
+
+    def _is_paused(self, history: List[Dict[str, Any]]) -> bool:
+        return bool(self.pause_after_epochs) and len(history) >= self.pause_after_epochs < self.epochs
+
+    def _save_last_checkpoint(self, trial: Trial) -> None:
+        # Saved when the epochs done since the last checkpoint would be lost otherwise. After an
+        # interrupt, the unfinished epoch is trained again when resumed, from the weights it reached
+        checkpointer = getattr(self, "_full_state_checkpoint", None)
+        if checkpointer is None:
+            return
+        epoch = len(trial.state[torchbearer.HISTORY])
+        checkpoints = list_checkpoints(self.checkpoints_dir)
+        last_epoch = get_checkpoint_epoch(checkpoints[-1]) if checkpoints else 0
+        if epoch > last_epoch:
+            print("Saving a checkpoint at epoch {}...".format(epoch))
+            checkpointer.save(trial.state, epoch)
+
+    def _fit_distributed_rank(
+        self, rank: int, port: int, module: nn.Module
+    ) -> List[Dict[str, Any]]:
+        if rank > 0:
+            sys.stdout = open(os.devnull, "w")
+        torch.set_num_threads(
+            self.distributed_threads_per_rank
+            or max(1, (os.cpu_count() or 1) // self.distributed_world_size)
         )
+        init_local_process_group(rank, self.distributed_world_size, port)
+        try:
+            return self._fit(DistributedModule(module))
+        finally:
+            torch.distributed.destroy_process_group()
 
-        self.after_fit()
-        self.evaluate()
-        self.cache_cleanup()
+    def _fit_distributed(self, module: nn.Module) -> List[Dict[str, Any]]:
+        if self.device == "cuda":
+            raise ValueError("The distributed training only supports the cpu device")
+
+        # The ranks are forked from this process, which runs the main rank, so they share the
+        # data already loaded (copy-on-write) and the main one keeps the training results
+        port = find_free_port()
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(
+                target=self._fit_distributed_rank,
+                args=(rank, port, module),
+                name="{}-rank{}".format(self.task_id, rank),
+            )
+            for rank in range(1, self.distributed_world_size)
+        ]
+        for process in processes:
+            process.start()
+
+        num_threads = torch.get_num_threads()
+        try:
+            history = self._fit_distributed_rank(0, port, module)
+        except BaseException:
+            for process in processes:
+                process.terminate()
+            raise
+        finally:
+            for process in processes:
+                process.join()
+            torch.set_num_threads(num_threads)
+
+        failed = [process.name for process in processes if process.exitcode != 0]
+        if failed:
+            raise RuntimeError("Distributed training failed in {}".format(", ".join(failed)))
+        return history
+
+    @property
+    def is_main_rank(self) -> bool:
+        return get_rank() == 0
 
     def get_sample_batch(self):
         return default_convert(self.train_dataset[0][0])
@@ -635,8 +952,7 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
         pass
 
     def evaluate(self):
-        self.cache_cleanup()
-        module     = self.get_trained_module()
+        module     = self.trained_module
         val_loader = self.get_val_generator()
 
         print("================== Evaluate ========================")
@@ -645,7 +961,7 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
                 module,
                 self._get_optimizer(module),
                 self._get_loss_function(),
-                callbacks=[],
+                callbacks=self.get_precision_callbacks(),
                 metrics=self.metrics,
             )
             .to(self.torch_device)
@@ -661,10 +977,35 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
             self.run_evaluate_task()
 
     def run_evaluate_task(self) -> None:
-        os.system(
-            "PYTHONPATH=. luigi --module mars_gym.evaluation.task EvaluateTestSetPredictions --model-task-class {}.{} --model-task-id {} --local-scheduler {}".format(self.__module__, type(self).__name__, self.task_id, self.run_evaluate_extra_params)
-        )      
+        # It depends on this module
+        from mars_gym.evaluation.task import EvaluateTestSetPredictions
+
+        # run_evaluate_extra_params keeps the command line format, so it is parsed by luigi
+        cmdline_args = [
+            EvaluateTestSetPredictions.get_task_family(),
+            "--model-task-class",
+            "{}.{}".format(self.__module__, type(self).__name__),
+            "--model-task-id",
+            self.task_id,
+            *shlex.split(self.run_evaluate_extra_params),
+        ]
+        try:
+            with CmdlineParser.global_instance(cmdline_args, allow_override=True) as parser:
+                task = parser.get_task_obj()
+        except SystemExit:
+            # argparse exits on invalid arguments
+            raise ValueError(
+                "Invalid run_evaluate_extra_params: {}".format(self.run_evaluate_extra_params)
+            )
 
+        # The evaluation runs in this process, reusing the data, the trained module and the
+        # predictions already in memory
+        task.set_model_training(self)
+        if hasattr(self, "_test_set_predictions"):
+            task.set_test_set_predictions(self._test_set_predictions)
+
+        if not luigi.build([task], local_scheduler=True):
+            raise RuntimeError("The evaluation of {} failed".format(self.task_id))
 
     def create_trial(self, module: nn.Module) -> Trial:
         loss_function = self._get_loss_function()
@@ -674,6 +1015,7 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
             loss_function,
             callbacks=self._get_callbacks(),
             metrics=self.metrics,
+            verbose=2 if self.is_main_rank else 0,
         ).to(self.torch_device)
         if hasattr(loss_function, "torchbearer_state"):
             loss_function.torchbearer_state = trial.state
@@ -683,13 +1025,71 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
         return TORCH_LOSS_FUNCTIONS[self.loss_function](**self.loss_function_params)
 
     def _get_optimizer(self, module) -> Optimizer:
-        return TORCH_OPTIMIZERS[self.optimizer](
-            module.parameters(), lr=self.learning_rate, **self.optimizer_params
-        )
+        sparse_params, dense_params = split_sparse_parameters(module)
+        if not sparse_params or self.optimizer == self.sparse_optimizer:
+            return TORCH_OPTIMIZERS[self.optimizer](
+                module.parameters(), lr=self.learning_rate, **self.optimizer_params
+            )
+
+        # The embeddings with sparse gradients get their own optimizer, which only touches
+        # the rows of the batch, while the dense layers use the configured one
+        optimizers = [
+            TORCH_SPARSE_OPTIMIZERS[self.sparse_optimizer](
+                sparse_params, lr=self.learning_rate, **self.sparse_optimizer_params
+            )
+        ]
+        if dense_params:
+            optimizers.append(
+                TORCH_OPTIMIZERS[self.optimizer](
+                    dense_params, lr=self.learning_rate, **self.optimizer_params
+                )
+            )
+        return MultipleOptimizer(optimizers)
+
+    @property
+    def autocast_enabled(self) -> bool:
+        return self.precision != "float32"
+
+    def autocast(self):
+        if self.autocast_enabled:
+            return torch.autocast(
+                self.torch_device.type, dtype=TORCH_PRECISIONS[self.precision]
+            )
+        return nullcontext()
+
+    def get_precision_callbacks(self) -> List[Callback]:
+        if self.autocast_enabled:
+            return [
+                AutocastCallback(self.torch_device.type, TORCH_PRECISIONS[self.precision])
+            ]
+        return []
 
     def _get_callbacks(self):
+        resuming = getattr(self, "_checkpoint", None) is not None
         callbacks = [
+            # It must come first to time the other callbacks as part of the steps
+            # and to add its metrics before they are logged
+            *([ThroughputMonitor()] if self.monitor_throughput else []),
+            *self.get_precision_callbacks(),
             *self._get_extra_callbacks(),
+        ]
+        if get_world_size() > 1:
+            # The throughput of each rank adds up, as well as its memory
+            callbacks.append(
+                DistributedSync(
+                    sum_metrics=["samples_per_sec", "batches_per_sec", "peak_rss_mb"]
+                )
+            )
+        if self.gradient_norm_clipping:
+            callbacks.append(
+                GradientNormClipping(
+                    self.gradient_norm_clipping, self.gradient_norm_clipping_type
+                )
+            )
+        if not self.is_main_rank:
+            return callbacks
+
+        callbacks += [
             ModelCheckpoint(
                 get_weights_path(self.output().path),
                 save_best_only=True,
@@ -702,26 +1102,62 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
                 monitor=self.monitor_metric,
                 mode=self.monitor_mode,
             ),
-            CSVLogger(get_history_path(self.output().path)),
+            CSVLogger(
+                get_history_path(self.output().path),
+                append=resuming,
+                write_header=not resuming,
+            ),
             TensorBoard(get_tensorboard_logdir(self.task_id), write_graph=False),
         ]
-        if self.gradient_norm_clipping:
-            callbacks.append(
-                GradientNormClipping(
-                    self.gradient_norm_clipping, self.gradient_norm_clipping_type
-                )
+        if self.checkpoint_every > 0:
+            # It must come last to save the updated state of the other callbacks
+            self._full_state_checkpoint = FullStateCheckpoint(
+                self.checkpoints_dir,
+                every=self.checkpoint_every,
+                keep_last=max(1, self.checkpoint_keep_last),
             )
+            callbacks.append(self._full_state_checkpoint)
         return callbacks
 
     def _get_extra_callbacks(self):
         return []
 
+    @property
+    def compiled_weights_path(self) -> Optional[str]:
+        return get_compiled_weights_path(self.output().path, self.inference_mode)
+
+    def get_recommendation_score_function(self, module: nn.Module, sample_input):
+        # The compiled function is kept while the same module is used to score the arms
+        if (
+            not hasattr(self, "_recommendation_score_function")
+            or self._recommendation_score_function[0] is not module
+        ):
+            self._recommendation_score_function = (
+                module,
+                get_recommendation_score_function(
+                    module,
+                    self.inference_mode,
+                    sample_input,
+                    cache_path=self.compiled_weights_path,
+                    weights_path=get_weights_path(self.output().path),
+                ),
+            )
+        return self._recommendation_score_function[1]
+
+    @property
+    def trained_module(self) -> nn.Module:
+        # The best weights are loaded once, and the module is shared by the evaluation and the
+        # predictions until the cache cleanup at the end of the task
+        if not hasattr(self, "_trained_module"):
+            self._trained_module = self.get_trained_module()
+        return self._trained_module
+
     def get_trained_module(self) -> nn.Module:
         module = self.create_module().to(self.torch_device)
         state_dict = torch.load(
             get_weights_path(self.output().path), map_location=self.torch_device
         )
-        module.load_state_dict(state_dict["model"])
+        module.load_state_dict(strip_distributed_prefix(state_dict["model"]))
         module.eval()
         return module
 
@@ -734,10 +1170,21 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
                 self._torch_device = torch.device("cpu")
         return self._torch_device
 
+    def _get_batch_sampler(self, dataset: Dataset, shuffle: bool) -> FasterBatchSampler:
+        world_size = get_world_size()
+        if world_size > 1:
+            return DistributedFasterBatchSampler(
+                dataset,
+                max(1, self.batch_size // world_size),
+                num_replicas=world_size,
+                rank=get_rank(),
+                shuffle=shuffle,
+                seed=self.seed,
+            )
+        return FasterBatchSampler(dataset, self.batch_size, shuffle=shuffle)
+
     def get_train_generator(self) -> DataLoader:
-        batch_sampler = FasterBatchSampler(
-            self.train_dataset, self.batch_size, shuffle=True
-        )
+        batch_sampler = self._get_batch_sampler(self.train_dataset, shuffle=True)
         return NoAutoCollationDataLoader(
             self.train_dataset,
             batch_sampler=batch_sampler,
@@ -748,9 +1195,7 @@ class TorchModelTraining(_BaseModelTraining, metaclass=abc.ABCMeta):
     def get_val_generator(self) -> Optional[DataLoader]:
         if len(self.val_data_frame) == 0:
             return None
-        batch_sampler = FasterBatchSampler(
-            self.val_dataset, self.batch_size, shuffle=False
-        )
+        batch_sampler = self._get_batch_sampler(self.val_dataset, shuffle=False)
         return NoAutoCollationDataLoader(
             self.val_dataset,
             batch_sampler=batch_sampler,
@@ -776,11 +1221,16 @@ class SupervisedModelTraining(TorchModelTraining):
         description="Should be like mars_gym.model.bandit.EpsilonGreedy",
     )
     bandit_policy_params: Dict[str, Any] = luigi.DictParameter(default={})
+    candidate_arms_size: int = luigi.IntParameter(default=101)
+    candidate_sampling: str = luigi.ChoiceParameter(choices=CANDIDATE_SAMPLINGS, default="uniform")
+    shared_candidate_arms: bool = luigi.BoolParameter(default=False)
+    full_catalog_scoring: bool = luigi.BoolParameter(default=False)
+    full_catalog_top_k: int = luigi.IntParameter(default=100)
 
     def create_agent(self) -> BanditAgent:
         bandit_class = load_attr(self.bandit_policy_class, Type[BanditPolicy])
         bandit = bandit_class(
-            reward_model=self.get_trained_module(), **self.bandit_policy_params
+            reward_model=self.trained_module, **self.bandit_policy_params
         )
         return BanditAgent(bandit)
 
@@ -795,6 +1245,110 @@ class SupervisedModelTraining(TorchModelTraining):
             self._unique_items = [x for x in self._unique_items if str(x) != 'nan']
         return self._unique_items
 
+    @property
+    def item_index_values(self) -> np.ndarray:
+        """The item of each index, the same as reverse_index_mapping, but built once and usable with arrays"""
+        if not hasattr(self, "_item_index_values"):
+            mapping = self.index_mapping[self.project_config.item_column.name]
+            self._item_index_values = np.full(max(mapping.values()) + 1, None, dtype=object)
+            for value, index in mapping.items():
+                self._item_index_values[index] = value
+            self._item_index_values[0] = 0
+        return self._item_index_values
+
+    @property
+    def candidate_items(self) -> np.ndarray:
+        if not hasattr(self, "_candidate_items"):
+            self._candidate_items = np.array(
+                map_array(self.unique_items, self.index_mapping[self.project_config.item_column.name]),
+                dtype=np.int64,
+            )
+        return self._candidate_items
+
+    @property
+    def candidate_probs(self) -> Optional[np.ndarray]:
+        if not hasattr(self, "_candidate_probs"):
+            self._candidate_probs = None
+            if self.candidate_sampling == "popularity":
+                item_counts = np.bincount(
+                    self.train_data_frame[self.project_config.item_column.name].to_numpy(dtype=np.int64),
+                    minlength=len(self.item_index_values),
+                )[self.candidate_items]
+                if item_counts.sum() > 0:
+                    self._candidate_probs = item_counts / item_counts.sum()
+        return self._candidate_probs
+
+    @property
+    def n_sampleable_candidates(self) -> int:
+        if self.candidate_probs is None:
+            return len(self.candidate_items)
+        return int(np.count_nonzero(self.candidate_probs))
+
+    @property
+    def shared_candidates(self) -> np.ndarray:
+        if not hasattr(self, "_shared_candidates"):
+            size = min(self.candidate_arms_size, self.n_sampleable_candidates)
+            self._shared_candidates = np.sort(
+                self.candidate_items[
+                    np.random.RandomState(self.seed).choice(
+                        len(self.candidate_items), size, replace=False, p=self.candidate_probs
+                    )
+                ]
+            )
+        return self._shared_candidates
+
+    def _sample_candidate_arms(
+        self, items: np.ndarray, random_states: List[np.random.RandomState]
+    ) -> List[np.ndarray]:
+        """
+        Samples the negative items of each observation, without replacement, with its random state,
+        and adds the observed items to them, returning the sorted item indices of each observation,
+        without repetitions.
+        """
+        n_obs = len(items)
+        if len(self.candidate_items) <= self.candidate_arms_size:
+            negatives = np.broadcast_to(self.candidate_items, (n_obs, len(self.candidate_items)))
+        elif self.shared_candidate_arms:
+            negatives = np.broadcast_to(self.shared_candidates, (n_obs, len(self.shared_candidates)))
+        else:
+            negatives = self.candidate_items[
+                self._draw_candidate_positions(
+                    random_states, min(self.candidate_arms_size, self.n_sampleable_candidates)
+                )
+            ]
+
+        # -1 for the unknown items, which aren't candidates
+        items = np.where(np.isin(items, self.candidate_items), items, -1)
+        candidates = np.sort(np.concatenate([negatives, items[:, None]], axis=1), axis=1)
+
+        keep = candidates >= 0
+        keep[:, 1:] &= candidates[:, 1:] != candidates[:, :-1]
+
+        return np.split(candidates[keep], np.cumsum(keep.sum(axis=1))[:-1])
+
+    def _draw_candidate_positions(
+        self, random_states: List[np.random.RandomState], size: int
+    ) -> np.ndarray:
+        """
+        The positions in candidate_items of the size candidates of each random state, the ones with
+        the highest random keys: uniform ones, or Gumbel ones added to the log-probabilities with
+        candidate_sampling=popularity, which samples them without replacement by their popularity.
+        """
+        positions = np.empty((len(random_states), size), dtype=np.int64)
+        batch_size = max(1, CANDIDATE_KEYS_PER_BATCH // len(self.candidate_items))
+        for start in range(0, len(random_states), batch_size):
+            keys = np.stack(
+                [
+                    random_state.random_sample(len(self.candidate_items))
+                    for random_state in random_states[start : start + batch_size]
+                ]
+            )
+            if self.candidate_probs is not None:
+                with np.errstate(divide="ignore"):
+                    keys = np.log(self.candidate_probs) - np.log(-np.log(keys))
+            positions[start : start + batch_size] = np.argpartition(-keys, size - 1, axis=1)[:, :size]
+        return positions
+
     @property
     def obs_columns(self) -> List[str]:
         if not hasattr(self, "_obs_columns"):
@@ -803,31 +1357,48 @@ class SupervisedModelTraining(TorchModelTraining):
             ]
         return self._obs_columns
 
-    def _get_arms(self, ob: dict) -> List[Any]:
-        #from IPython import embed; embed()
+    @property
+    def random_state(self) -> np.random.RandomState:
+        # Draws the arms of the simulation, which is seeded once
+        if not hasattr(self, "_random_state"):
+            self._random_state = np.random.RandomState(self.seed)
+        return self._random_state
+
+    def _get_observation_random_states(self, positions: np.ndarray) -> List[np.random.RandomState]:
+        # Seeded by the position of each observation, so its arms are the same in whatever chunk it's
+        return [
+            np.random.RandomState(np.random.PCG64([self.seed, position]))
+            for position in positions.tolist()
+        ]
 
+    def _get_arms_list(
+        self, obs: List[Dict[str, Any]], random_states: List[np.random.RandomState]
+    ) -> Tuple[List[List[Any]], Optional[List[List[int]]]]:
         if self.project_config.available_arms_column_name:
-            arms = ob[self.project_config.available_arms_column_name]
-            arms = random.sample(arms, len(arms))
+            # Shuffled, so the ties are broken at random
+            arms_list = [
+                [arms[j] for j in random_state.permutation(len(arms))]
+                for arms, random_state in zip(
+                    (ob[self.project_config.available_arms_column_name] for ob in obs), random_states
+                )
+            ]
+            return arms_list, None
         else: # Only Supervised Mode
-            #raise("available_arms_column_name not exist")
-            if ob[self.project_config.item_column.name] in self.reverse_index_mapping[self.project_config.item_column.name]:
-                ob_item = self.reverse_index_mapping[self.project_config.item_column.name][ob[self.project_config.item_column.name]]
-                arms = random.sample(self.unique_items, min(101, len(self.unique_items)))
-                arms.append(ob_item)
-                arms = list(np.unique(arms))
-            else:
-                arms = random.sample(self.unique_items, min(100, len(self.unique_items)))
-
-        return arms
+            items = np.array([ob[self.project_config.item_column.name] for ob in obs], dtype=np.int64)
+            arm_indices_list = self._sample_candidate_arms(items, random_states)
+            arms_list = [self.item_index_values[arm_indices].tolist() for arm_indices in arm_indices_list]
+            return arms_list, [arm_indices.tolist() for arm_indices in arm_indices_list]
 
     def _get_arm_scores(self, agent: BanditAgent, ob_dataset: Dataset) -> List[float]:
         batch_sampler = FasterBatchSampler(ob_dataset, self.batch_size, shuffle=False)
+        # With its own generator, the loader doesn't draw its seed from the global RNG, so the
+        # shuffles of the next trainings don't depend on how many times the arms were scored
         generator = NoAutoCollationDataLoader(
             ob_dataset,
             batch_sampler=batch_sampler,
             num_workers=self.generator_workers,
             pin_memory=self.pin_memory if self.device == "cuda" else False,
+            generator=torch.Generator(),
         )
 
         model = agent.bandit.reward_model
@@ -841,35 +1412,40 @@ class SupervisedModelTraining(TorchModelTraining):
                 input_params = x if isinstance(x, list) or isinstance(x, tuple) else [x]
                 input_params = [t.to(self.torch_device) if isinstance(t, torch.Tensor) else t for t in input_params]
 
-                scores_tensor: torch.Tensor  = model.recommendation_score(*input_params)
-                scores_batch: List[float] = scores_tensor.cpu().numpy().reshape(-1).tolist()
+                score_function = self.get_recommendation_score_function(model, input_params)
+                with self.autocast():
+                    scores_tensor: torch.Tensor  = score_function(*input_params)
+                scores_batch: List[float] = scores_tensor.float().cpu().numpy().reshape(-1).tolist()
                 scores.extend(scores_batch)
 
         return scores
 
-    def plot_scores(self, scores):
-        plt.figure()
-
-        try:
-            sns_plot = sns.distplot(scores, hist=False, color="g", kde_kws={"shade": True})
-        except RuntimeError as re:
-            if str(re).startswith("Selected KDE bandwidth is 0. Cannot estimate density."):
-                sns_plot = sns.distplot(scores, hist=False, color="g", kde_kws={'bw': 0.1})
-            else:
-                raise re
-        
-
-        figure = sns_plot.get_figure()
-        figure.savefig(os.path.join(self.output().path, "scores.png"))
-        plt.close(figure)
+    def plot_scores(self, distribution: ScoreDistribution):
+        distribution.save(os.path.join(self.output().path, "scores.json"))
+        self.plotter.submit(
+            os.path.join(self.output().path, "scores.png"), plot_scores, distribution,
+        )
 
-    def _create_ob_data_frame(self, ob: dict, arm_indices: List[int]) -> pd.DataFrame:
-        data = [
-            {**ob, self.project_config.item_column.name: arm_index}
-            for arm_index in arm_indices
-        ]
+    def _create_obs_data_frame(
+        self, obs: List[Dict[str, Any]], arm_indices_list: List[List[int]]
+    ) -> Tuple[pd.DataFrame, np.ndarray]:
+        """
+        Builds a single data frame with a row for each arm of each observation, column by column.
+        Returns it with the offsets of the observations, whose rows are offsets[i]:offsets[i + 1].
+        """
+        arm_counts = np.array([len(arm_indices) for arm_indices in arm_indices_list], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(arm_counts)])
+        ob_positions = np.repeat(np.arange(len(obs)), arm_counts)
+
+        columns = {
+            column: pd.Series([ob.get(column) for ob in obs]).to_numpy()[ob_positions]
+            for column in self.obs_columns
+        }
+        columns[self.project_config.item_column.name] = pd.Series(
+            list(itertools.chain.from_iterable(arm_indices_list))
+        ).to_numpy()
         ob_df = pd.DataFrame(
-            columns=self.obs_columns + [self.project_config.item_column.name], data=data
+            columns, columns=self.obs_columns + [self.project_config.item_column.name]
         )
 
         ob_df = self._fill_hist_columns(ob_df)
@@ -880,7 +1456,7 @@ class SupervisedModelTraining(TorchModelTraining):
             if auxiliar_output_column.name not in ob_df.columns:
                 ob_df[auxiliar_output_column.name] = 0
 
-        return ob_df
+        return ob_df, offsets
 
     def _fill_hist_columns(self, ob_df: pd.DataFrame) -> pd.DataFrame:
         if self.project_config.hist_view_column_name not in ob_df:
@@ -890,61 +1466,52 @@ class SupervisedModelTraining(TorchModelTraining):
         return ob_df
 
     def _prepare_for_agent(
-        self, agent: BanditAgent, obs: List[Dict[str, Any]]
+        self,
+        agent: BanditAgent,
+        obs: List[Dict[str, Any]],
+        random_states: Optional[List[np.random.RandomState]] = None,
     ) -> Tuple[
         List[Tuple[np.ndarray, ...]],
         List[List[Any]],
         List[List[int]],
         List[List[float]],
     ]:
-        arms_list = [self._get_arms(ob) for ob in obs]
+        arms_list, arm_indices_list = self._get_arms_list(
+            obs, [self.random_state] * len(obs) if random_states is None else random_states
+        )
 
         # TODO
         # If a column in available_arms_column_name was used in (auxiliar_output_columns, other_input_columns) its not necessery
-        if self.project_config.item_column.type in [
-            IOType.INDEXABLE,
-            IOType.INDEXABLE_ARRAY,
-        ]:
-            arm_indices_list = [
-                map_array(
-                    arms, self.index_mapping[self.project_config.item_column.name]
-                )
-                for arms in arms_list
-            ]
-        else:
-            arm_indices_list = cast(List[List[int]], arms_list)
-        # from IPython import embed; embed()
-        # print("A")
-        # ob_dfs = []
-        # for ob, arm_indices in tqdm(zip(obs, arm_indices_list), total=len(obs)):
-        #     ob_dfs.append(self._create_ob_data_frame(ob, arm_indices))
-        # print("B")
-        ob_dfs = [
-            self._create_ob_data_frame(ob, arm_indices)
-            for ob, arm_indices in zip(obs, arm_indices_list)
-        ]
-        
+        if arm_indices_list is None:
+            if self.project_config.item_column.type in [
+                IOType.INDEXABLE,
+                IOType.INDEXABLE_ARRAY,
+            ]:
+                arm_indices_list = [
+                    map_array(
+                        arms, self.index_mapping[self.project_config.item_column.name]
+                    )
+                    for arms in arms_list
+                ]
+            else:
+                arm_indices_list = cast(List[List[int]], arms_list)
+        obs_df, offsets = self._create_obs_data_frame(obs, arm_indices_list)
 
         obs_dataset = InteractionsDataset(
-            pd.concat(ob_dfs),
+            obs_df,
             obs[0][ITEM_METADATA_KEY],
             self.project_config,
             self.index_mapping,
         )
 
-        arm_contexts_list: List[Tuple[np.ndarray, ...]] = []
-        i = 0
-        for ob_df in ob_dfs:
-            arm_contexts_list.append(obs_dataset[i : i + len(ob_df)][0])
-            i += len(ob_df)
+        bounds = list(zip(offsets[:-1].tolist(), offsets[1:].tolist()))
+        arm_contexts_list: List[Tuple[np.ndarray, ...]] = [
+            obs_dataset[start:end][0] for start, end in bounds
+        ]
 
         if agent.bandit.reward_model:
             all_arm_scores = self._get_arm_scores(agent, obs_dataset)
-            arm_scores_list = []
-            i = 0
-            for ob_df in ob_dfs:
-                arm_scores_list.append(all_arm_scores[i : i + len(ob_df)])
-                i += len(ob_df)
+            arm_scores_list = [all_arm_scores[start:end] for start, end in bounds]
         else:
             arm_scores_list = [
                 agent.bandit.calculate_scores(arm_indices, arm_contexts)
@@ -956,14 +1523,18 @@ class SupervisedModelTraining(TorchModelTraining):
         return arm_contexts_list, arms_list, arm_indices_list, arm_scores_list
 
     def _act(self, agent: BanditAgent, ob: dict) -> int:
+        return self._act_batch(agent, [ob])[0]
+
+    def _act_batch(self, agent: BanditAgent, obs: List[Dict[str, Any]]) -> List[Tuple[int, float]]:
+        # The arms of all the observations are scored in a single pass
         (
             arm_contexts_list,
             _,
             arm_indices_list,
             arm_scores_list,
-        ) = self._prepare_for_agent(agent, [ob])
+        ) = self._prepare_for_agent(agent, obs)
 
-        return agent.act(arm_indices_list[0], arm_contexts_list[0], arm_scores_list[0])
+        return agent.act_batch(arm_indices_list, arm_contexts_list, arm_scores_list)
 
     # def clean(self):
     #     if hasattr(self, "_train_dataset"):
@@ -980,73 +1551,268 @@ class SupervisedModelTraining(TorchModelTraining):
 
     #     gc.collect()
 
-    def _save_test_set_predictions(self, agent: BanditAgent) -> None:
-        print("Saving test set predictions...")
-        
-        if self.sample_size_eval and len(self.test_data_frame) > self.sample_size_eval:
-            obs: List[Dict[str, Any]] = self.test_data_frame.sample(self.sample_size_eval, random_state=self.seed).to_dict("records")
-        else:
-            obs: List[Dict[str, Any]] = self.test_data_frame.to_dict("records")
+    def _get_test_set_positions(self) -> np.ndarray:
+        positions = np.arange(len(self.test_data_frame))
+        if self.sample_size_eval and len(positions) > self.sample_size_eval:
+            # The same rows selected by DataFrame.sample, in the order of the file, to be read in a
+            # single pass
+            positions = np.sort(
+                pd.Series(positions)
+                .sample(self.sample_size_eval, random_state=self.seed)
+                .to_numpy()
+            )
+        return positions
+
+    def _get_interaction_keys(self, df: pd.DataFrame) -> np.ndarray:
+        # Each encoded (user, item) pair as a single int64
+        users = df[self.project_config.user_column.name].to_numpy(dtype=np.int64)
+        items = df[self.project_config.item_column.name].to_numpy(dtype=np.int64)
+        return users * len(self.item_index_values) + items
+
+    @property
+    def trained_pairs(self) -> np.ndarray:
+        """The sorted keys of the (user, item) pairs of the train and validation sets"""
+        if not hasattr(self, "_trained_pairs"):
+            self._trained_pairs = np.unique(
+                np.concatenate(
+                    [
+                        self._get_interaction_keys(self.train_data_frame),
+                        self._get_interaction_keys(self.val_data_frame),
+                    ]
+                )
+            )
+        return self._trained_pairs
+
+    def _score_full_catalog(self, obs: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Retrieves the full_catalog_top_k items with the highest scores for each observation, from the
+        dot products of the user and item representations of the module, instead of scoring sampled arms.
+        """
+        module = self.trained_module
+        if not isinstance(module, RecommenderModule) or not module.has_representations:
+            raise ValueError(
+                "{} doesn't expose user and item representations for the full catalog scoring".format(
+                    type(module).__name__
+                )
+            )
+        module.to(self.torch_device)
+        module.eval()
+
+        user_ids = torch.tensor(
+            [ob[self.project_config.user_column.name] for ob in obs], dtype=torch.int64
+        )
+        top_scores_list = []
+        top_items_list = []
+        with torch.no_grad():
+            item_representations = module.item_representation(
+                torch.from_numpy(self.candidate_items).to(self.torch_device)
+            )
+            for batch_user_ids in torch.split(user_ids, self.batch_size):
+                top_scores, top_positions = top_k_by_dot_product(
+                    module.user_representation(batch_user_ids.to(self.torch_device)),
+                    item_representations,
+                    self.full_catalog_top_k,
+                )
+                top_scores_list.append(module.representation_score(top_scores).float().cpu().numpy())
+                top_items_list.append(self.candidate_items[top_positions.cpu().numpy()])
+
+        arms = self.item_index_values[np.concatenate(top_items_list)]
+        return arms, np.concatenate(top_scores_list).astype(np.float64)
+
+    def _predict_test_set_chunk(
+        self,
+        agent: BanditAgent,
+        positions: np.ndarray,
+        test_rows_df: pd.DataFrame,
+    ) -> Tuple[pd.DataFrame, List[float]]:
+        obs: List[Dict[str, Any]] = self.test_data_frame.iloc[positions].to_dict("records")
 
-        for ob in tqdm(obs, total=len(obs)):
+        for ob in obs:
             if self.embeddings_for_metadata is not None:
                 ob[ITEM_METADATA_KEY] = self.embeddings_for_metadata
             else:
                 ob[ITEM_METADATA_KEY] = None
 
-        print("...prepare_for_agent")
-        (
-            arm_contexts_list,
-            arms_list,
-            arm_indices_list,
-            arm_scores_list,
-        ) = self._prepare_for_agent(agent, obs)
-        print("...")
-        
-        sorted_actions_list = []
-        proba_actions_list  = []
-
-        for arm_contexts, arms, arm_indices, arm_scores in tqdm(
-            zip(arm_contexts_list, arms_list, arm_indices_list, arm_scores_list),
-            total=len(arm_contexts_list),
-        ):
-            sorted_actions, proba_actions = agent.rank(
-                arms, arm_indices, arm_contexts, arm_scores
+        if self.full_catalog_scoring:
+            arm_contexts_list = None
+            arms, arm_scores = self._score_full_catalog(obs)
+            arm_indices = None
+            mask = np.ones(arm_scores.shape, dtype=bool)
+        else:
+            (
+                arm_contexts_list,
+                arms_list,
+                arm_indices_list,
+                arm_scores_list,
+            ) = self._prepare_for_agent(
+                agent, obs, self._get_observation_random_states(positions)
             )
-            sorted_actions_list.append(sorted_actions)
-            proba_actions_list.append(proba_actions)
 
-        action_scores_list = [
-            list(reversed(sorted(action_scores))) for action_scores in arm_scores_list
-        ]
+            arms, mask = pad_sequences(arms_list, fill_value=None, dtype=object)
+            arm_indices, _ = pad_sequences(arm_indices_list, fill_value=-1, dtype=np.int64)
+            arm_scores, _ = pad_sequences(arm_scores_list)
+
+        ranked_arms, propensities, sorted_scores = agent.rank_batch(
+            arms,
+            arm_scores,
+            mask,
+            arm_contexts_list,
+            limit=self.predictions_top_k,
+            arm_indices=arm_indices,
+        )
+
+        n_arms_list = np.minimum(mask.sum(axis=1), ranked_arms.shape[1]).tolist()
+        sorted_actions_list = [row[:n].tolist() for row, n in zip(ranked_arms, n_arms_list)]
+        proba_actions_list = [row[:n].tolist() for row, n in zip(propensities, n_arms_list)]
+        action_scores_list = [row[:n].tolist() for row, n in zip(sorted_scores, n_arms_list)]
 
-        del obs
+        del obs, arm_contexts_list
 
         # Create evaluation file
-        df = pd.read_csv(self.test_data_frame_path)
-        if self.sample_size_eval and len(self.test_data_frame) > self.sample_size_eval:
-            df = df.sample(self.sample_size_eval, random_state=self.seed)
-        
+        df = test_rows_df.set_index(pd.Index(positions))
+
         df["sorted_actions"] = sorted_actions_list
         df["prob_actions"]   = proba_actions_list
         df["action_scores"]  = action_scores_list
-        
-        # join with train interaction information
-        df_train = self.get_data_frame_interactions()[[self.project_config.user_column.name, self.project_config.item_column.name]]
-        df_train['trained'] = 1
-        df = df.merge(df_train, on = [self.project_config.user_column.name, self.project_config.item_column.name], how='left')
-        df['trained'] =  df['trained'].fillna(0)
-        
+
+        # train interaction information
+        encoded_df = self.test_data_frame.iloc[positions]
+        keys = self._get_interaction_keys(encoded_df)
+        found = np.minimum(np.searchsorted(self.trained_pairs, keys), max(len(self.trained_pairs) - 1, 0))
+        df['trained'] = (self.trained_pairs[found] == keys).astype(float) if len(self.trained_pairs) else 0.0
+
         # Add indexed information
-        df['item_indexed'] = df[self.project_config.item_column.name].apply(lambda i: self.index_mapping[self.project_config.item_column.name][str(i)] > 0)
-        
-        scores = [score for arm_scores in arm_scores_list for score in arm_scores]
-        self.plot_scores(scores)
+        df['item_indexed'] = encoded_df[self.project_config.item_column.name].to_numpy() > 0
+
+        return df, arm_scores[mask]
+
+    @property
+    def test_set_predictions_path(self) -> str:
+        return get_test_set_predictions_path(self.output().path, self.predictions_format)
+
+    def _get_test_set_predictions_part_path(self, chunk: int) -> str:
+        return os.path.join(self.test_set_predictions_path, "part-%05d.parquet" % chunk)
+
+    def _load_test_set_predictions_progress(self, progress: Dict[str, Any]) -> Dict[str, Any]:
+        progress_path = get_test_set_predictions_progress_path(self.output().path)
+        if os.path.exists(progress_path) and os.path.exists(self.test_set_predictions_path):
+            with open(progress_path) as progress_file:
+                saved_progress = json.load(progress_file)
+            if all(saved_progress.get(key) == progress[key] for key in ("num_rows", "chunk_size", "format")):
+                progress = saved_progress
+
+        # Drops whatever was written after the last completed chunk
+        if self.predictions_format == "csv":
+            if os.path.exists(self.test_set_predictions_path):
+                with open(self.test_set_predictions_path, "r+b") as predictions_file:
+                    predictions_file.truncate(progress["file_size"])
+        else:
+            os.makedirs(self.test_set_predictions_path, exist_ok=True)
+            completed_parts = {
+                os.path.basename(self._get_test_set_predictions_part_path(chunk))
+                for chunk in range(progress["chunks"])
+            }
+            for file_name in os.listdir(self.test_set_predictions_path):
+                if file_name not in completed_parts:
+                    os.remove(os.path.join(self.test_set_predictions_path, file_name))
+
+        # Predictions left by a run with the other format
+        for predictions_format in PREDICTIONS_FORMATS:
+            path = get_test_set_predictions_path(self.output().path, predictions_format)
+            if predictions_format != self.predictions_format and os.path.isdir(path):
+                shutil.rmtree(path)
+            elif predictions_format != self.predictions_format and os.path.exists(path):
+                os.remove(path)
+
+        return progress
+
+    def _write_test_set_predictions_chunk(self, df: pd.DataFrame, chunk: int) -> int:
+        if self.predictions_format == "csv":
+            df.to_csv(self.test_set_predictions_path, mode="w" if chunk == 0 else "a", header=chunk == 0, index=False)
+            return os.path.getsize(self.test_set_predictions_path)
+
+        part_path = self._get_test_set_predictions_part_path(chunk)
+        # Hidden while it's written, so a partial part is never read
+        tmp_path = os.path.join(os.path.dirname(part_path), "." + os.path.basename(part_path))
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, part_path)
+        return 0
+
+    def _save_test_set_predictions_progress(self, progress: Dict[str, Any]) -> None:
+        progress_path = get_test_set_predictions_progress_path(self.output().path)
+        with open(progress_path + ".tmp", "w") as progress_file:
+            json.dump(progress, progress_file)
+        os.replace(progress_path + ".tmp", progress_path)
+
+    def _save_test_set_predictions(self, agent: BanditAgent) -> None:
+        """
+        Generates, scores and ranks the arms of the test set in chunks of prediction_chunk_size
+        observations, appending each chunk to the predictions file, so the memory doesn't grow
+        with the test set. The progress is saved after every chunk, to resume from the last one.
+        """
+        print("Saving test set predictions...")
 
-        self._to_csv_test_set_predictions(df)
+        positions = self._get_test_set_positions()
+        chunk_size = max(1, self.prediction_chunk_size)
+        chunks = [positions[i : i + chunk_size] for i in range(0, len(positions), chunk_size)]
+
+        progress = self._load_test_set_predictions_progress(
+            dict(
+                num_rows=len(positions),
+                chunk_size=chunk_size,
+                format=self.predictions_format,
+                chunks=0,
+                file_size=0,
+            )
+        )
+        if 0 < progress["chunks"] < len(chunks):
+            print(
+                "Resuming the test set predictions from chunk {}/{}...".format(
+                    progress["chunks"] + 1, len(chunks)
+                )
+            )
+
+        # The dtypes take a pass over the whole file, so they are inferred once and kept with the
+        # progress, for the resumed runs
+        if "dtypes" not in progress:
+            progress["dtypes"] = {
+                column: dtype.name
+                for column, dtype in read_csv_dtypes(self.test_data_frame_path, chunk_size).items()
+            }
+
+        # Only the rows of the chunk being predicted are read
+        test_rows = read_csv_rows(
+            self.test_data_frame_path,
+            chunks[progress["chunks"] :],
+            chunk_size,
+            dtypes={column: np.dtype(name) for column, name in progress["dtypes"].items()},
+        )
+
+        distribution = (
+            ScoreDistribution.from_dict(progress["score_distribution"])
+            if "score_distribution" in progress
+            else ScoreDistribution()
+        )
+        if hasattr(self, "_test_set_predictions"):
+            del self._test_set_predictions
 
-    def _to_csv_test_set_predictions(self, df: pd.DataFrame) -> None:
-        df.to_csv(get_test_set_predictions_path(self.output().path), index=False)
+        for i in tqdm(range(progress["chunks"], len(chunks)), total=len(chunks), initial=progress["chunks"]):
+            df, chunk_scores = self._predict_test_set_chunk(agent, chunks[i], next(test_rows))
+
+            distribution.update(chunk_scores)
+
+            file_size = self._write_test_set_predictions_chunk(df, i)
+            progress.update(
+                chunks=i + 1, file_size=file_size, score_distribution=distribution.to_dict()
+            )
+            self._save_test_set_predictions_progress(progress)
+
+            if len(chunks) == 1:
+                # Small enough to be handed to the evaluation in memory
+                self._test_set_predictions = df
+
+        if self.diagnostics != "off" and distribution.count > 0:
+            self.plot_scores(distribution)
 
     def after_fit(self):
         if self.test_size > 0:
@@ -1070,12 +1836,8 @@ class DummyTraining(SupervisedModelTraining):
         pass
 
     def train(self):
-        print("train_data_frame:")
-        print(self.train_data_frame.describe())
+        self.save_data_diagnostics()
 
-        sample_data = self.train_data_frame.sample(100, replace=True)
-        sample_data.to_csv(os.path.join(self.output().path, "sample_train.csv"))
-        
         self.fit(df_train=pd.concat([self.train_data_frame, self.val_data_frame]))
         self.after_fit()
         self.evaluate()
@@ -1096,10 +1858,6 @@ class DummyTraining(SupervisedModelTraining):
         if self.run_evaluate:
             self.run_evaluate_task()
 
-    def run_evaluate_task(self) -> None:
-        os.system(
-            "PYTHONPATH=. luigi --module mars_gym.evaluation.task EvaluateTestSetPredictions --model-task-class {}.{} --model-task-id {} --local-scheduler {}".format(self.__module__, type(self).__name__, self.task_id, self.run_evaluate_extra_params)
-        )     
 
 def load_torch_model_training_from_task_dir(
     model_cls: Type[TorchModelTraining], task_dir: str
@@ -0,0 +1,289 @@
+import glob
+import os
+import random
+import re
+import resource
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torchbearer
+from torchbearer.callbacks import Callback
+
+THROUGHPUT_METRICS = [
+    "data_wait_time",
+    "compute_time",
+    "samples_per_sec",
+    "batches_per_sec",
+    "peak_rss_mb",
+]
+
+
+def _to_float32(value: Any) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.is_floating_point() else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_float32(v) for v in value)
+    return value
+
+
+class AutocastCallback(Callback):
+    """
+    Runs only the forward pass of the model under torch.autocast. The predictions are cast back
+    to float32, so the loss, the metrics and the optimizer state are kept in float32.
+    """
+
+    def __init__(self, device_type: str = "cpu", dtype: torch.dtype = torch.bfloat16):
+        super().__init__()
+        self.device_type = device_type
+        self.dtype = dtype
+        self._autocast = None
+
+    def _enter(self):
+        self._exit()
+        self._autocast = torch.autocast(self.device_type, dtype=self.dtype)
+        self._autocast.__enter__()
+
+    def _exit(self):
+        if self._autocast is not None:
+            self._autocast.__exit__(None, None, None)
+            self._autocast = None
+
+    def on_sample(self, state):
+        self._enter()
+
+    def on_sample_validation(self, state):
+        self._enter()
+
+    def on_forward(self, state):
+        self._exit()
+        state[torchbearer.Y_PRED] = _to_float32(state[torchbearer.Y_PRED])
+
+    def on_forward_validation(self, state):
+        self._exit()
+        state[torchbearer.Y_PRED] = _to_float32(state[torchbearer.Y_PRED])
+
+    def on_end_epoch(self, state):
+        self._exit()
+
+    def on_end_validation(self, state):
+        self._exit()
+
+    def on_end(self, state):
+        self._exit()
+
+
+def _batch_size(state) -> int:
+    for key in (torchbearer.Y_TRUE, torchbearer.X):
+        value = state[key] if key in state else None
+        while isinstance(value, (list, tuple)) and len(value) > 0:
+            value = value[0]
+        if isinstance(value, torch.Tensor) and value.dim() > 0:
+            return value.shape[0]
+    return 0
+
+
+def _peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+
+class ThroughputMonitor(Callback):
+    """
+    Splits each epoch into the time spent waiting for the batches (loading them and copying them
+    to the device) and the time spent in forward/backward, and adds them to the epoch metrics,
+    so they end up in history.csv and TensorBoard. It should be the first callback of the trial.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._epochs: List[Dict[str, float]] = []
+
+    def _reset(self):
+        self._data_wait_time = 0.0
+        self._compute_time = 0.0
+        self._train_time = 0.0
+        self._train_batches = 0
+        self._train_samples = 0
+
+    def _start_phase(self):
+        self._phase_start = self._last_step = time.perf_counter()
+
+    def _sample(self):
+        self._sampled_at = time.perf_counter()
+        self._data_wait_time += self._sampled_at - self._last_step
+
+    def _step(self):
+        self._last_step = time.perf_counter()
+        self._compute_time += self._last_step - self._sampled_at
+
+    def on_start_epoch(self, state):
+        self._reset()
+
+    def on_start_training(self, state):
+        self._start_phase()
+
+    def on_sample(self, state):
+        self._sample()
+
+    def on_step_training(self, state):
+        self._step()
+        self._train_batches += 1
+        self._train_samples += _batch_size(state)
+
+    def on_end_training(self, state):
+        self._train_time += time.perf_counter() - self._phase_start
+
+    def on_start_validation(self, state):
+        self._start_phase()
+
+    def on_sample_validation(self, state):
+        self._sample()
+
+    def on_step_validation(self, state):
+        self._step()
+
+    def on_end_epoch(self, state):
+        train_time = max(self._train_time, 1e-9)
+        metrics = {
+            "data_wait_time": self._data_wait_time,
+            "compute_time": self._compute_time,
+            "samples_per_sec": self._train_samples / train_time,
+            "batches_per_sec": self._train_batches / train_time,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+        self._epochs.append(metrics)
+        state[torchbearer.METRICS].update(metrics)
+
+    def on_end(self, state):
+        if not self._epochs:
+            return
+        data_wait_time = sum(epoch["data_wait_time"] for epoch in self._epochs)
+        compute_time = sum(epoch["compute_time"] for epoch in self._epochs)
+        print(
+            "Throughput: {:.1f} samples/s, {:.1f} batches/s, data wait {:.1f}% of the time, peak RSS {:.0f} MB".format(
+                np.mean([epoch["samples_per_sec"] for epoch in self._epochs]),
+                np.mean([epoch["batches_per_sec"] for epoch in self._epochs]),
+                100 * data_wait_time / max(data_wait_time + compute_time, 1e-9),
+                self._epochs[-1]["peak_rss_mb"],
+            )
+        )
+
+
+def get_rng_states() -> Dict[str, Any]:
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_states(rng_states: Dict[str, Any]) -> None:
+    random.setstate(rng_states["python"])
+    np.random.set_state(rng_states["numpy"])
+    torch.set_rng_state(rng_states["torch"])
+    if rng_states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+
+def get_checkpoint_epoch(path: str) -> int:
+    return int(re.search(r"checkpoint_(\d+)\.pt$", path).group(1))
+
+
+def list_checkpoints(directory: str) -> List[str]:
+    return sorted(
+        glob.glob(os.path.join(directory, "checkpoint_*.pt")), key=get_checkpoint_epoch
+    )
+
+
+def load_latest_checkpoint(directory: str) -> Optional[Dict[str, Any]]:
+    checkpoints = list_checkpoints(directory)
+    if not checkpoints:
+        return None
+    return torch.load(checkpoints[-1], map_location="cpu")
+
+
+class FullStateCheckpoint(Callback):
+    """
+    Periodically saves everything needed to resume the training: the trial state (model, optimizer,
+    history and the state of the other callbacks, like the early stopping counters) and the RNG
+    states. The checkpoints are taken at the end of the epochs, so the sampler resumes at the start
+    of the next epoch, with the same shuffling thanks to the restored RNG states.
+    It should be the last callback of the trial, to capture the updated state of the others.
+    """
+
+    def __init__(self, directory: str, every: int = 1, keep_last: int = 2):
+        super().__init__()
+        self.directory = directory
+        self.every = every
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+
+    def on_checkpoint(self, state):
+        epoch = state[torchbearer.EPOCH] + 1
+        if epoch % self.every != 0:
+            return
+        self.save(state, epoch)
+
+    def save(self, state, epoch: int):
+        """Saves the state as the one to resume the training from, at the start of the epoch"""
+        checkpoint = {
+            "epoch": epoch,
+            "trial": state[torchbearer.SELF].state_dict(),
+            "rng_states": get_rng_states(),
+            "stop_training": bool(state.get(torchbearer.STOP_TRAINING, False)),
+        }
+        path = os.path.join(self.directory, "checkpoint_%04d.pt" % epoch)
+        tmp_path = path + ".tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+        for old_path in list_checkpoints(self.directory)[: -self.keep_last]:
+            os.remove(old_path)
+
+
+class DistributedSync(Callback):
+    """
+    Keeps the ranks of a distributed training in step: it sets the epoch of the distributed
+    samplers, averages the epoch metrics across the ranks (summing the ones in sum_metrics), so
+    every rank logs and monitors the same values, and stops all the ranks when the main one
+    (which runs the early stopping) stops. It must come before the callbacks that use the metrics.
+    """
+
+    def __init__(self, sum_metrics: List[str] = ()):
+        super().__init__()
+        self.sum_metrics = set(sum_metrics)
+
+    def on_start_epoch(self, state):
+        for key in (torchbearer.TRAIN_GENERATOR, torchbearer.VALIDATION_GENERATOR):
+            generator = state[key] if key in state else None
+            batch_sampler = getattr(generator, "batch_sampler", None)
+            if hasattr(batch_sampler, "set_epoch"):
+                batch_sampler.set_epoch(state[torchbearer.EPOCH])
+
+    def on_end_epoch(self, state):
+        metrics = state[torchbearer.METRICS]
+        keys = sorted(
+            key
+            for key, value in metrics.items()
+            if isinstance(value, (int, float))
+            or (isinstance(value, torch.Tensor) and value.numel() == 1)
+        )
+        if not keys:
+            return
+
+        values = torch.tensor([float(metrics[key]) for key in keys], dtype=torch.float64)
+        dist.all_reduce(values)
+        world_size = dist.get_world_size()
+        for key, value in zip(keys, values.tolist()):
+            metrics[key] = value if key in self.sum_metrics else value / world_size
+
+    def on_checkpoint(self, state):
+        stop_training = torch.tensor([float(bool(state[torchbearer.STOP_TRAINING]))])
+        dist.all_reduce(stop_training, op=dist.ReduceOp.MAX)
+        state[torchbearer.STOP_TRAINING] = bool(stop_training.item())
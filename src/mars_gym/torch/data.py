@@ -1,3 +1,4 @@
+import math
 from typing import List
 
 import torch
@@ -41,6 +42,64 @@ class FasterBatchSampler(Sampler):
                 yield iter_list[i:last_idx]
 
 
+class DistributedFasterBatchSampler(FasterBatchSampler):
+    """
+    FasterBatchSampler that only yields the batches of one rank of a distributed training.
+    The shuffling depends only on the seed and the epoch, so the ranks agree on the split without
+    communicating, and the indices are padded to be evenly divisible, so they run the same number
+    of steps. set_epoch must be called at the start of every epoch.
+    """
+
+    def __init__(
+        self,
+        data_source: Dataset,
+        batch_size: int,
+        num_replicas: int,
+        rank: int,
+        drop_last: bool = False,
+        shuffle: bool = False,
+        seed: int = 0,
+    ):
+        super().__init__(data_source, batch_size, drop_last=drop_last, shuffle=shuffle)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    @property
+    def num_rank_samples(self):
+        return math.ceil(self.num_samples / self.num_replicas)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_rank_samples // self.batch_size
+        else:
+            return (self.num_rank_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            iter_list: List[int] = torch.randperm(
+                self.num_samples, generator=generator
+            ).tolist()
+        else:
+            iter_list: List[int] = list(range(self.num_samples))
+
+        total_size = self.num_rank_samples * self.num_replicas
+        if total_size > len(iter_list):
+            iter_list = (iter_list * math.ceil(total_size / len(iter_list)))[:total_size]
+        iter_list = iter_list[self.rank : total_size : self.num_replicas]
+
+        for i in range(0, self.num_rank_samples, self.batch_size):
+            last_idx = i + self.batch_size
+            if last_idx <= self.num_rank_samples or not self.drop_last:
+                yield iter_list[i:last_idx]
+
+
 class NoAutoCollationDataLoader(DataLoader):
     @property
     def _auto_collation(self):
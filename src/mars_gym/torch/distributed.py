@@ -0,0 +1,52 @@
+import socket
+from datetime import timedelta
+
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+DISTRIBUTED_BACKEND = "gloo"
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def init_local_process_group(
+    rank: int, world_size: int, port: int, timeout: timedelta = timedelta(minutes=30)
+) -> None:
+    dist.init_process_group(
+        DISTRIBUTED_BACKEND,
+        init_method="tcp://127.0.0.1:{}".format(port),
+        rank=rank,
+        world_size=world_size,
+        timeout=timeout,
+    )
+
+
+def get_rank() -> int:
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+class DistributedModule(DistributedDataParallel):
+    """
+    DistributedDataParallel that drops the state passed by torchbearer to the forward, so it isn't
+    run twice (once with the state and once without it) with the collectives of each run.
+    """
+
+    def forward(self, *inputs, state=None, **kwargs):
+        return super().forward(*inputs, **kwargs)
+
+
+def strip_distributed_prefix(state_dict: dict) -> dict:
+    prefix = "module."
+    if state_dict and all(key.startswith(prefix) for key in state_dict.keys()):
+        return type(state_dict)(
+            (key[len(prefix) :], value) for key, value in state_dict.items()
+        )
+    return state_dict
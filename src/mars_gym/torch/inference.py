@@ -0,0 +1,98 @@
+import os
+from typing import Callable, Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+from mars_gym.model.abstract import RecommenderModule
+
+INFERENCE_MODES = ["eager", "trace", "script"]
+
+
+def compile_recommendation_score(
+    module: nn.Module, mode: str, sample_input: Sequence[torch.Tensor]
+) -> torch.jit.ScriptModule:
+    if mode == "trace":
+        return torch.jit.trace_module(
+            module, {"recommendation_score": tuple(sample_input)}, check_trace=False
+        )
+    if mode == "script":
+        # Only forward is compiled by torch.jit.script, so it can only replace
+        # the default recommendation_score
+        if type(module).recommendation_score is not RecommenderModule.recommendation_score:
+            raise ValueError(
+                "{} overrides recommendation_score and can't be scripted".format(
+                    type(module).__name__
+                )
+            )
+        return torch.jit.script(module)
+    raise ValueError("Unknown inference mode: {}".format(mode))
+
+
+def _get_score_function(compiled: torch.jit.ScriptModule, mode: str) -> Callable:
+    return compiled.recommendation_score if mode == "trace" else compiled.forward
+
+
+def _outputs_match(expected, actual) -> bool:
+    if isinstance(expected, torch.Tensor):
+        return (
+            isinstance(actual, torch.Tensor)
+            and expected.shape == actual.shape
+            and torch.allclose(expected.float(), actual.float(), rtol=1e-4, atol=1e-5)
+        )
+    if isinstance(expected, (list, tuple)):
+        return (
+            isinstance(actual, (list, tuple))
+            and len(expected) == len(actual)
+            and all(_outputs_match(e, a) for e, a in zip(expected, actual))
+        )
+    return False
+
+
+def get_recommendation_score_function(
+    module: nn.Module,
+    mode: str,
+    sample_input: Sequence[torch.Tensor],
+    cache_path: Optional[str] = None,
+    weights_path: Optional[str] = None,
+) -> Callable:
+    """
+    Returns a compiled version of module.recommendation_score, falling back to the eager one
+    when the module can't be compiled. The compiled module is cached in cache_path, and reused
+    as long as it is newer than the weights in weights_path.
+    """
+    if mode == "eager":
+        return module.recommendation_score
+
+    device = next(module.parameters()).device
+    try:
+        if (
+            cache_path
+            and weights_path
+            and os.path.exists(cache_path)
+            and os.path.exists(weights_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(weights_path)
+        ):
+            compiled = torch.jit.load(cache_path, map_location=device)
+        else:
+            compiled = compile_recommendation_score(module, mode, sample_input)
+            if cache_path:
+                torch.jit.save(compiled, cache_path)
+
+        score_function = _get_score_function(compiled, mode)
+        with torch.no_grad():
+            if not _outputs_match(
+                module.recommendation_score(*sample_input), score_function(*sample_input)
+            ):
+                raise ValueError("the compiled module doesn't reproduce the eager outputs")
+    except Exception as e:
+        print(
+            "Falling back to eager mode, {} can't be compiled with {}: {}".format(
+                type(module).__name__, mode, e
+            )
+        )
+        if cache_path and os.path.exists(cache_path):
+            os.remove(cache_path)
+        return module.recommendation_score
+
+    return score_function
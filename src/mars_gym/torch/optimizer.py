@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Tuple, Union
 
 import torch
 import torchbearer
@@ -317,3 +317,149 @@ class AdamW(Optimizer):
                 p.data.copy_(p_data_fp32)
 
         return loss
+
+
+class LazyAdam(Optimizer):
+    """
+    Adam that, for sparse gradients (like the ones of nn.Embedding(sparse=True)), only updates
+    the moments and the values of the rows present in the batch, so the cost of a step doesn't
+    grow with the size of the embedding tables. Dense gradients get the usual Adam update.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+        if not 0.0 <= lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0.0 <= eps:
+            raise ValueError("Invalid epsilon value: {}".format(eps))
+        if not 0.0 <= betas[0] < 1.0:
+            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
+        if not 0.0 <= betas[1] < 1.0:
+            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
+
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(LazyAdam, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+
+                state["step"] += 1
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                step_size = group["lr"] * math.sqrt(bias_correction2) / bias_correction1
+
+                if grad.is_sparse:
+                    grad = grad.coalesce()
+                    indices = grad._indices()[0]
+                    values = grad._values()
+                    if group["weight_decay"] != 0:
+                        values = values.add(p[indices], alpha=group["weight_decay"])
+
+                    exp_avg_rows = exp_avg[indices].mul_(beta1).add_(values, alpha=1 - beta1)
+                    exp_avg_sq_rows = (
+                        exp_avg_sq[indices]
+                        .mul_(beta2)
+                        .addcmul_(values, values, value=1 - beta2)
+                    )
+                    exp_avg[indices] = exp_avg_rows
+                    exp_avg_sq[indices] = exp_avg_sq_rows
+
+                    p.index_add_(
+                        0,
+                        indices,
+                        exp_avg_rows / exp_avg_sq_rows.sqrt().add_(group["eps"]),
+                        alpha=-step_size,
+                    )
+                else:
+                    if group["weight_decay"] != 0:
+                        grad = grad.add(p, alpha=group["weight_decay"])
+
+                    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                    p.addcdiv_(
+                        exp_avg, exp_avg_sq.sqrt().add_(group["eps"]), value=-step_size
+                    )
+
+        return loss
+
+
+def split_sparse_parameters(
+    module: nn.Module,
+) -> Tuple[List[nn.Parameter], List[nn.Parameter]]:
+    """
+    Splits the parameters of the module into the ones with sparse gradients (the weights of the
+    embeddings created with sparse=True) and the rest.
+    """
+    sparse_ids = {
+        id(submodule.weight)
+        for submodule in module.modules()
+        if isinstance(submodule, (nn.Embedding, nn.EmbeddingBag)) and submodule.sparse
+    }
+    sparse_params, dense_params = [], []
+    for param in module.parameters():
+        (sparse_params if id(param) in sparse_ids else dense_params).append(param)
+    return sparse_params, dense_params
+
+
+class MultipleOptimizer(object):
+    """
+    Combines optimizers of disjoint parameter groups, like a SparseAdam for the sparse embeddings
+    and the configured optimizer for the dense layers, behind the interface used by the Trial.
+    """
+
+    def __init__(self, optimizers: List[Optimizer]):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self) -> List[dict]:
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    @property
+    def state(self) -> dict:
+        return {
+            param: param_state
+            for optimizer in self.optimizers
+            for param, param_state in optimizer.state.items()
+        }
+
+    def zero_grad(self, set_to_none: bool = False):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+        return loss
+
+    def state_dict(self) -> dict:
+        return {"optimizers": [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict: dict):
+        for optimizer, optimizer_state_dict in zip(
+            self.optimizers, state_dict["optimizers"]
+        ):
+            optimizer.load_state_dict(optimizer_state_dict)
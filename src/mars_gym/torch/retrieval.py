@@ -0,0 +1,36 @@
+from typing import Tuple
+
+import torch
+
+
+def top_k_by_dot_product(
+    user_representations: torch.Tensor,
+    item_representations: torch.Tensor,
+    k: int,
+    item_block_size: int = 65536,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Exact top-k items of each user by the dot product of their representations. The items are
+    multiplied in blocks of item_block_size, merging the top-k of each block with the best ones so
+    far, so the memory is bounded by n_users x (k + item_block_size) scores.
+    Returns the top-k dot products and the positions of their items, in descending order.
+    """
+    n_users = user_representations.shape[0]
+    k = min(k, item_representations.shape[0])
+
+    top_scores = user_representations.new_empty((n_users, 0))
+    top_positions = torch.empty((n_users, 0), dtype=torch.int64, device=user_representations.device)
+
+    for start in range(0, item_representations.shape[0], item_block_size):
+        block = item_representations[start : start + item_block_size]
+        block_scores = user_representations @ block.T
+        block_positions = torch.arange(
+            start, start + block.shape[0], device=user_representations.device
+        ).expand(n_users, -1)
+
+        scores = torch.cat((top_scores, block_scores), dim=1)
+        positions = torch.cat((top_positions, block_positions), dim=1)
+        top_scores, top_indices = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+        top_positions = torch.gather(positions, 1, top_indices)
+
+    return top_scores, top_positions
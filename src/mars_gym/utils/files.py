@@ -19,6 +19,14 @@ def get_weights_path(task_dir: str) -> str:
     return os.path.join(task_dir, "weights.pt")
 
 
+def get_compiled_weights_path(task_dir: str, inference_mode: str) -> str:
+    return os.path.join(task_dir, "weights.%s.pt" % inference_mode)
+
+
+def get_checkpoints_dir(task_dir: str) -> str:
+    return os.path.join(task_dir, "checkpoints")
+
+
 def get_history_path(task_dir: str) -> str:
     return os.path.join(task_dir, "history.csv")
 
@@ -49,9 +57,17 @@ def get_ground_truth_datalog_path(task_dir: str) -> str:
     return os.path.join(task_dir, "gt-datalog.csv")
 
 
-def get_test_set_predictions_path(task_dir: str) -> str:
-    return os.path.join(task_dir, "test_set_predictions.csv")
+def get_test_set_predictions_path(task_dir: str, predictions_format: str = "csv") -> str:
+    return os.path.join(task_dir, "test_set_predictions.%s" % predictions_format)
+
+
+def get_test_set_predictions_progress_path(task_dir: str) -> str:
+    return os.path.join(task_dir, "test_set_predictions_progress.json")
 
 
 def get_index_mapping_path(task_dir: str) -> str:
     return os.path.join(task_dir, "index_mapping.pkl")
+
+
+def get_data_frame_cache_path(cache_key: str) -> str:
+    return os.path.join(OUTPUT_PATH, "cache", "data_frames", "%s.feather" % cache_key)
@@ -1,14 +1,19 @@
-from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
 
 import matplotlib
 
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 import pandas as pd
 import seaborn as sns
 import numpy as np
 
+from mars_gym.torch.callbacks import THROUGHPUT_METRICS
+from mars_gym.utils.sketch import ScoreDistribution
+
 sns.set()
 plt.style.use("default")
 
@@ -17,10 +22,17 @@ def plot_history(history_df: pd.DataFrame) -> Figure:
     metrics = [
         column
         for column in history_df.columns
-        if column != "epoch" and "val_" not in column and "running_" not in column
+        if column != "epoch"
+        and "val_" not in column
+        and "running_" not in column
+        and not column.endswith("_steps")
+        and column not in THROUGHPUT_METRICS
     ]
 
-    fig = plt.figure(figsize=(8 * len(metrics), 5))
+    # The object-oriented API doesn't touch the global state of pyplot, so it can be
+    # used outside of the main thread
+    fig = Figure(figsize=(8 * len(metrics), 5))
+    FigureCanvasAgg(fig)
 
     for i, metric in enumerate(metrics):
         ax = fig.add_subplot(1, len(metrics), i + 1)
@@ -39,12 +51,50 @@ def plot_history(history_df: pd.DataFrame) -> Figure:
     return fig
 
 
-def plot_scores(scores: np.array) -> Figure:
-    fig = plt.figure()
+def plot_scores(distribution: ScoreDistribution) -> Figure:
+    fig = Figure()
+    FigureCanvasAgg(fig)
 
     ax = fig.add_subplot(1, 1, 1)
-    ax.hist(scores)
+    histogram = distribution.histogram
+    if histogram.edges is not None:
+        ax.hist(histogram.edges[:-1], bins=histogram.edges, weights=histogram.counts)
+        for q, linestyle in ((0.05, ":"), (0.5, "--"), (0.95, ":")):
+            ax.axvline(
+                distribution.sketch.quantile(q),
+                color="k",
+                linestyle=linestyle,
+                label="p%g" % (100 * q),
+            )
+        ax.legend()
+    ax.set_xlabel("score")
+    ax.set_ylabel("count")
 
     fig.tight_layout()
 
     return fig
+
+
+class BackgroundPlotter(object):
+    """
+    Renders and saves the figures in a background thread, so the plots never block the training.
+    The plot functions must create their figures with the object-oriented API, like plot_history.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: List[Future] = []
+
+    def submit(self, path: str, plot_fn: Callable[..., Figure], *args, **kwargs) -> None:
+        def _plot():
+            plot_fn(*args, **kwargs).savefig(path)
+
+        self._futures.append(self._executor.submit(_plot))
+
+    def wait(self) -> None:
+        futures, self._futures = self._futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("Could not save the plot: {}".format(e))
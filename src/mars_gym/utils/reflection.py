@@ -20,7 +20,10 @@ def load_attr(attr_path: str, expected_type: Type[T]) -> T:
     module = importlib.import_module(module_path)
     attr = getattr(module, attr_name)
 
-    if isinstance(expected_type, GenericMeta):  # the expected_type is a type itself
+    if (
+        isinstance(expected_type, GenericMeta)
+        or getattr(expected_type, "__origin__", None) is type
+    ):  # the expected_type is a type itself
         if not issubclass(attr, expected_type.__args__[0]):
             raise ValueError(f"{attr_path} should be a sub class of {expected_type}")
     else:
@@ -0,0 +1,260 @@
+import collections
+import json
+import math
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+SUMMARY_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def _finite_values(values: Iterable[float]) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    return values[np.isfinite(values)]
+
+
+class StreamingHistogram(object):
+    """
+    Histogram with a fixed number of bins, updated chunk by chunk and mergeable. The width of the
+    bins is a power of two and they start at a multiple of it, so when the values go out of their
+    range the width doubles, merging each pair of bins, and any two histograms can be brought to
+    the same bins to be merged.
+    """
+
+    def __init__(self, bins: int = 100) -> None:
+        self.bins = bins
+        self.width: Optional[float] = None
+        # The first edge is start * width
+        self.start = 0
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def edges(self) -> Optional[np.ndarray]:
+        if self.width is None:
+            return None
+        return (self.start + np.arange(self.bins + 1)) * self.width
+
+    def _add_bins(self, counts: np.ndarray, start: int, width: float) -> None:
+        # Bins whose width divides the one of this histogram, and within its range
+        ratio = int(round(self.width / width))
+        nonzero = np.flatnonzero(counts)
+        np.add.at(self.counts, (start + nonzero) // ratio - self.start, counts[nonzero])
+
+    def _cover(self, low: float, high: float, min_width: float = 0.0) -> None:
+        if self.width is None:
+            # The smallest power of two whose bins would span the values
+            span = max(high - low, 2.0 ** -40 * max(abs(low), abs(high), 1.0))
+            width = 2.0 ** math.ceil(math.log2(span / self.bins))
+        else:
+            width = self.width
+            low, high = min(low, self.min), max(high, self.max)
+        width = max(width, min_width)
+
+        start = math.floor(low / width)
+        while high >= (start + self.bins) * width:
+            width *= 2
+            start = math.floor(low / width)
+
+        if self.width is None:
+            self.width, self.start = width, start
+        elif (width, start) != (self.width, self.start):
+            counts, old_start, old_width = self.counts, self.start, self.width
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+            self.width, self.start = width, start
+            self._add_bins(counts, old_start, old_width)
+
+    def update(self, values: Iterable[float]) -> None:
+        values = _finite_values(values)
+        if len(values) == 0:
+            return
+
+        low, high = float(values.min()), float(values.max())
+        self._cover(low, high)
+        self.counts += np.bincount(
+            np.floor(values / self.width).astype(np.int64) - self.start, minlength=self.bins
+        )
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def merge(self, other: "StreamingHistogram") -> None:
+        if other.width is None:
+            return
+        if other.bins != self.bins:
+            raise ValueError("Only histograms with the same number of bins can be merged")
+
+        self._cover(other.min, other.max, min_width=other.width)
+        self._add_bins(other.counts, other.start, other.width)
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "width": self.width,
+            "start": self.start,
+            "edges": self.edges.tolist() if self.edges is not None else None,
+            "counts": self.counts.tolist(),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "StreamingHistogram":
+        histogram = cls(bins=len(data["counts"]))
+        histogram.width = data["width"]
+        histogram.start = data["start"]
+        histogram.counts = np.array(data["counts"], dtype=np.int64)
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.min = data["min"] if data["min"] is not None else math.inf
+        histogram.max = data["max"] if data["max"] is not None else -math.inf
+        return histogram
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch in the style of DDSketch: the values are counted in logarithmic
+    buckets, so any quantile is estimated within relative_accuracy of the true value, with a
+    memory that depends on the range of the values, not on how many there are.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-9) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive: Dict[int, int] = collections.Counter()
+        self.negative: Dict[int, int] = collections.Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def _update_store(self, store: Dict[int, int], values: np.ndarray) -> None:
+        if len(values) == 0:
+            return
+        keys, counts = np.unique(
+            np.ceil(np.log(values) / self._log_gamma).astype(np.int64), return_counts=True
+        )
+        store.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def update(self, values: Iterable[float]) -> None:
+        values = _finite_values(values)
+        positive = values > self.min_value
+        negative = values < -self.min_value
+
+        self._update_store(self.positive, values[positive])
+        self._update_store(self.negative, -values[negative])
+        self.zero_count += int(len(values) - positive.sum() - negative.sum())
+        self.count += len(values)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _value(self, key: int) -> float:
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return math.nan
+
+        rank = q * (self.count - 1)
+        cumulative = 0
+        for key in sorted(self.negative, reverse=True):
+            cumulative += self.negative[key]
+            if cumulative > rank:
+                return -self._value(key)
+        cumulative += self.zero_count
+        if cumulative > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            cumulative += self.positive[key]
+            if cumulative > rank:
+                return self._value(key)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def quantiles(self, qs: Iterable[float] = SUMMARY_QUANTILES) -> Dict[str, float]:
+        return {"p%g" % (100 * q): self.quantile(q) for q in qs}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "positive": {str(key): count for key, count in self.positive.items()},
+            "negative": {str(key): count for key, count in self.negative.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "QuantileSketch":
+        sketch = cls(data["relative_accuracy"], data["min_value"])
+        sketch.positive.update({int(key): count for key, count in data["positive"].items()})
+        sketch.negative.update({int(key): count for key, count in data["negative"].items()})
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        return sketch
+
+
+class ScoreDistribution(object):
+    """The histogram and the quantile sketch of the scores, accumulated chunk by chunk"""
+
+    def __init__(self, bins: int = 100, relative_accuracy: float = 0.01) -> None:
+        self.histogram = StreamingHistogram(bins)
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, scores: Iterable[float]) -> None:
+        scores = _finite_values(scores)
+        self.histogram.update(scores)
+        self.sketch.update(scores)
+
+    def merge(self, other: "ScoreDistribution") -> None:
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def count(self) -> int:
+        return self.histogram.count
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.histogram.count,
+            "mean": self.histogram.mean,
+            "min": self.histogram.min,
+            "max": self.histogram.max,
+            **self.sketch.quantiles(),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "summary": self.summary() if self.count else {},
+            "histogram": self.histogram.to_dict(),
+            "sketch": self.sketch.to_dict(),
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ScoreDistribution":
+        distribution = cls()
+        distribution.histogram = StreamingHistogram.from_dict(data["histogram"])
+        distribution.sketch = QuantileSketch.from_dict(data["sketch"])
+        return distribution
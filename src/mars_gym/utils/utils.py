@@ -2,7 +2,7 @@ import os
 import ast
 from datetime import datetime, timedelta
 from multiprocessing.pool import Pool
-from typing import List, Union, Dict, Tuple
+from typing import Iterator, List, Optional, Union, Dict, Tuple
 from zipfile import ZipFile
 #from google.cloud import storage
 import json
@@ -84,6 +84,78 @@ def chunks(l: Union[list, range], n: int) -> Union[list, range]:
         yield l[i : i + n]
 
 
+def pad_sequences(
+    sequences: List[list], fill_value=np.nan, dtype=np.float64
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Stacks the sequences into a (n_sequences x max_length) matrix, padded at the end, and its mask of valid positions."""
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    max_length = int(lengths.max()) if len(lengths) else 0
+    mask = np.arange(max_length) < lengths[:, None]
+    padded = np.full((len(sequences), max_length), fill_value, dtype=dtype)
+    for i, sequence in enumerate(sequences):
+        padded[i, : len(sequence)] = sequence
+    return padded, mask
+
+
+def _common_dtype(dtypes: List[np.dtype]) -> np.dtype:
+    # The dtype of a column read at once, from the ones of its blocks
+    if all(dtype == dtypes[0] for dtype in dtypes):
+        return dtypes[0]
+    if all(dtype.kind in "iuf" for dtype in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(object)
+
+
+def read_csv_dtypes(path: str, block_size: int = 10000) -> Dict[str, np.dtype]:
+    """The dtype of each column of a csv file read at once, passing over it a block at a time"""
+    block_dtypes: Dict[str, List[np.dtype]] = {}
+    for block in pd.read_csv(path, chunksize=block_size):
+        for column, dtype in block.dtypes.items():
+            block_dtypes.setdefault(column, []).append(dtype)
+    return {column: _common_dtype(column_dtypes) for column, column_dtypes in block_dtypes.items()}
+
+
+def read_csv_rows(
+    path: str,
+    positions_list: List[np.ndarray],
+    block_size: int = 10000,
+    dtypes: Optional[Dict[str, np.dtype]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yields the rows at each array of positions of a csv file, passing once over the file, a block at a
+    time, so only a block and an array of rows are in memory. The positions must increase across all
+    the arrays. Every column gets the same dtype in all of them, from dtypes, or else from
+    read_csv_dtypes, which takes another pass, so it should be inferred once for repeated reads.
+    """
+    if not positions_list:
+        return
+    if dtypes is None:
+        dtypes = read_csv_dtypes(path, block_size)
+
+    positions = np.concatenate(positions_list)
+    ends = np.cumsum([len(chunk_positions) for chunk_positions in positions_list])
+    skip = int(positions[0])
+    reader = pd.read_csv(
+        path, dtype=dtypes, chunksize=block_size, skiprows=lambda line: 0 < line <= skip
+    )
+
+    start = skip
+    rows = []
+    i = 0
+    for block in reader:
+        low, high = np.searchsorted(positions, [start, start + len(block)])
+        rows.append(block.iloc[positions[low:high] - start])
+        start += len(block)
+
+        while i < len(positions_list) and high >= ends[i]:
+            df = pd.concat(rows)
+            yield df.iloc[: len(positions_list[i])]
+            rows = [df.iloc[len(positions_list[i]) :]]
+            i += 1
+        if i == len(positions_list):
+            return
+
+
 def parallel_literal_eval(
     series: Union[pd.Series, np.ndarray], pool: Pool = None, use_tqdm: bool = True
 ) -> list:
@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+
+from mars_gym.model.bandit import (
+    ModelPolicy,
+    AdaptiveGreedy,
+    SoftmaxExplorer,
+    CustomRewardModelLinUCB,
+)
+from mars_gym.utils.utils import pad_sequences
+
+
+class TestBanditRankBatch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.arm_scores_list = [list(rng.rand(n)) for n in rng.randint(1, 10, size=20)]
+        self.arm_scores_list.append([0.5, 0.2, 0.5, 0.5])
+        self.arm_scores, self.mask = pad_sequences(self.arm_scores_list)
+
+    def test_rank_batch_matches_rank(self):
+        ranked_positions, propensities, sorted_scores = ModelPolicy(None).rank_batch(
+            self.arm_scores, self.mask
+        )
+
+        for i, arm_scores in enumerate(self.arm_scores_list):
+            n_arms = len(arm_scores)
+            ranked, probs = ModelPolicy(None).rank(
+                list(range(n_arms)),
+                list(range(n_arms)),
+                arm_scores=arm_scores,
+                with_probs=True,
+            )
+            self.assertEqual(ranked_positions[i, :n_arms].tolist(), ranked)
+            self.assertEqual(propensities[i, :n_arms].tolist(), probs)
+            self.assertEqual(
+                sorted_scores[i, :n_arms].tolist(), sorted(arm_scores, reverse=True)
+            )
+            self.assertTrue((ranked_positions[i, n_arms:] == -1).all())
+
+    def test_rank_batch_one_by_one(self):
+        expected, _, _ = ModelPolicy(None).rank_batch(self.arm_scores, self.mask)
+        ranked_positions, _, _ = AdaptiveGreedy(
+            None, exploration_threshold=0.0
+        ).rank_batch(self.arm_scores, self.mask, limit=3)
+
+        np.testing.assert_array_equal(ranked_positions, expected[:, :3])
+
+    def test_rank_batch_one_by_one_breaks_ties_by_arm(self):
+        arms = ["a", "c", "b"]
+        arm_indices = [3, 1, 2]
+        arm_contexts = (np.zeros(3), np.array(arm_indices))
+        policy = CustomRewardModelLinUCB(None, alpha=0.0)
+
+        expected = policy.rank(arms, arm_indices, arm_contexts, [0.5, 0.5, 0.5])
+        ranked_positions, _, _ = policy.rank_batch(
+            np.full((1, 3), 0.5),
+            np.ones((1, 3), dtype=bool),
+            [arm_contexts],
+            arms=np.array([arms], dtype=object),
+            arm_indices=np.array([arm_indices]),
+        )
+
+        self.assertEqual(expected, [arms[position] for position in ranked_positions[0]])
+
+    def test_gumbel_top_k_ranks_every_arm(self):
+        ranked_positions, propensities, _ = SoftmaxExplorer(None).rank_batch(
+            self.arm_scores, self.mask
+        )
+
+        for i, arm_scores in enumerate(self.arm_scores_list):
+            n_arms = len(arm_scores)
+            self.assertEqual(sorted(ranked_positions[i, :n_arms]), list(range(n_arms)))
+            self.assertAlmostEqual(np.sum(propensities[i, :n_arms]), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,11 +4,22 @@ os.environ["OUTPUT_PATH"] = "tests/output"
 
 import unittest
 import luigi
+import numpy as np
+import pandas as pd
+import torch
 import torch.nn as nn
 from mars_gym.model.base_model import LogisticRegression
 from mars_gym.simulation.interaction import InteractionTraining
 from mars_gym.simulation.training import SupervisedModelTraining
+from mars_gym.simulation.sweep import HyperparameterSweep
 from mars_gym.evaluation.task import EvaluateTestSetPredictions
+from mars_gym.utils.files import (
+    get_history_path,
+    get_simulator_datalog_path,
+    get_task_dir,
+    get_test_set_predictions_path,
+    get_weights_path,
+)
 from unittest.mock import patch
 import shutil
 
@@ -38,6 +49,33 @@ class TestTraining(unittest.TestCase):
 
         luigi.build([job], local_scheduler=True)
 
+    def test_interaction_training_with_simulation_batches(self):
+        logs, rng_states = [], []
+        # The batches stop at each refit, so scoring them together changes nothing
+        for simulation_batch_size in [1, 30]:
+            job = InteractionTraining(
+                project="tests.factories.config.test_base_training",
+                recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+                recommender_extra_params={"n_factors": 10},
+                epochs=1,
+                test_size=0.1,
+                obs_batch_size=100,
+                simulation_batch_size=simulation_batch_size,
+                crm_ps_strategy="dataset",
+                bandit_policy_class="mars_gym.model.bandit.EpsilonGreedy",
+                bandit_policy_params={"epsilon": 0.1},
+            )
+            self.assertTrue(luigi.build([job], local_scheduler=True))
+            logs.append(
+                pd.read_csv(get_simulator_datalog_path(job.output().path))[["item", "reward"]]
+            )
+            rng_states.append(torch.get_rng_state())
+
+        self.assertGreater(len(logs[0]), 100)
+        pd.testing.assert_frame_equal(logs[0], logs[1])
+        # Neither do the scoring passes draw from the RNG of the trainings
+        self.assertTrue(torch.equal(rng_states[0], rng_states[1]))
+
     def test_batch_training_and_evaluation(self):
         # Training
         job = SupervisedModelTraining(
@@ -58,6 +96,181 @@ class TestTraining(unittest.TestCase):
 
         luigi.build([job], local_scheduler=True)
 
+    def test_batch_training_with_chunked_predictions(self):
+        job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10},
+            prediction_chunk_size=50,
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+        chunked_df = pd.read_parquet(job.test_set_predictions_path)
+        self.assertEqual(len(job.test_data_frame), len(chunked_df))
+
+        evaluate_job = EvaluateTestSetPredictions(
+            model_task_id=job.task_id,
+            model_task_class="mars_gym.simulation.training.SupervisedModelTraining",
+        )
+        self.assertTrue(luigi.build([evaluate_job], local_scheduler=True))
+
+        # The same trained model, predicting the whole test set in a single chunk
+        single_chunk_job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10},
+            prediction_chunk_size=len(chunked_df),
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertEqual(job.task_id, single_chunk_job.task_id)
+        single_chunk_job.after_fit()
+        single_chunk_df = pd.read_parquet(single_chunk_job.test_set_predictions_path)
+
+        pd.testing.assert_frame_equal(chunked_df, single_chunk_df)
+
+    def test_batch_training_with_sampled_candidate_arms(self):
+        job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training_without_available_arms",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10},
+            candidate_arms_size=10,
+            candidate_sampling="popularity",
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+
+        # 10 negatives, sampled without replacement, and the observed item if it isn't one of them
+        predictions_df = pd.read_parquet(job.test_set_predictions_path)
+        self.assertEqual(len(job.test_data_frame), len(predictions_df))
+        for item, item_indexed, sorted_actions in zip(
+            predictions_df["item"], predictions_df["item_indexed"], predictions_df["sorted_actions"]
+        ):
+            self.assertEqual(len(set(sorted_actions)), len(sorted_actions))
+            if item_indexed:
+                self.assertIn(str(item), sorted_actions)
+                self.assertIn(len(sorted_actions), [10, 11])
+            else:
+                self.assertEqual(10, len(sorted_actions))
+
+        evaluate_job = EvaluateTestSetPredictions(
+            model_task_id=job.task_id,
+            model_task_class="mars_gym.simulation.training.SupervisedModelTraining",
+        )
+        self.assertTrue(luigi.build([evaluate_job], local_scheduler=True))
+
+    def test_batch_training_with_full_catalog_scoring(self):
+        job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training_without_available_arms",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10},
+            full_catalog_scoring=True,
+            full_catalog_top_k=10,
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+
+        # The top 10 of scoring every item of the catalog with the module
+        module = job.get_trained_module()
+        users = torch.tensor(job.test_data_frame["user"].to_numpy(), dtype=torch.int64)
+        items = torch.from_numpy(job.candidate_items)
+        with torch.no_grad():
+            scores = torch.stack(
+                [module(users, torch.full_like(users, item)) for item in items.tolist()], dim=1
+            ).numpy()
+        top_scores = -np.sort(-scores, axis=1)[:, :10]
+
+        predictions_df = pd.read_parquet(job.test_set_predictions_path)
+        item_mapping = job.index_mapping["item"]
+        item_positions = {item: j for j, item in enumerate(job.candidate_items.tolist())}
+        for i, (sorted_actions, action_scores) in enumerate(
+            zip(predictions_df["sorted_actions"], predictions_df["action_scores"])
+        ):
+            positions = [item_positions[item_mapping[item]] for item in sorted_actions]
+            np.testing.assert_allclose(scores[i, positions], action_scores, atol=1e-5)
+            np.testing.assert_allclose(top_scores[i], action_scores, atol=1e-5)
+
+        evaluate_job = EvaluateTestSetPredictions(
+            model_task_id=job.task_id,
+            model_task_class="mars_gym.simulation.training.SupervisedModelTraining",
+        )
+        self.assertTrue(luigi.build([evaluate_job], local_scheduler=True))
+
+    def test_batch_training_with_sparse_embeddings(self):
+        job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10, "sparse": True},
+            sparse_optimizer="lazy_adam",
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+
+        self.assertTrue(os.path.exists(get_weights_path(job.output().path)))
+        history_df = pd.read_csv(get_history_path(job.output().path))
+        self.assertEqual([0, 1], history_df["epoch"].tolist())
+        self.assertFalse(history_df["loss"].isna().any())
+        predictions_df = pd.read_parquet(
+            get_test_set_predictions_path(job.output().path, "parquet")
+        )
+        self.assertEqual(len(job.test_data_frame), len(predictions_df))
+
+    def test_distributed_batch_training(self):
+        job = SupervisedModelTraining(
+            project="tests.factories.config.test_base_training",
+            recommender_module_class="mars_gym.model.base_model.LogisticRegression",
+            recommender_extra_params={"n_factors": 10},
+            distributed_world_size=2,
+            epochs=2,
+            test_size=0.1,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+
+        # Only the main rank logs and saves the model
+        weights_files = [name for name in os.listdir(job.output().path) if name.endswith(".pt")]
+        self.assertEqual(["weights.pt"], weights_files)
+        history_df = pd.read_csv(get_history_path(job.output().path))
+        self.assertEqual([0, 1], history_df["epoch"].tolist())
+        self.assertIsInstance(job.get_trained_module(), LogisticRegression)
+
+    def test_hyperparameter_sweep(self):
+        job = HyperparameterSweep(
+            model_task_params={
+                "project": "tests.factories.config.test_base_training",
+                "recommender_module_class": "mars_gym.model.base_model.LogisticRegression",
+                "recommender_extra_params": {"n_factors": 10},
+                "epochs": 4,
+                "test_size": 0.1,
+            },
+            grid={
+                "learning_rate": [0.001, 0.01],
+                "recommender_extra_params.n_factors": [5, 10],
+            },
+            num_workers=2,
+            successive_halving=True,
+            halving_eta=2,
+        )
+        self.assertTrue(luigi.build([job], local_scheduler=True))
+
+        results_df = pd.read_csv(job.output().path)
+        self.assertEqual([4, 2, 1], results_df.groupby("rung").size().tolist())
+        self.assertEqual([1, 2, 4], results_df.groupby("rung")["epochs"].max().tolist())
+        self.assertTrue((results_df["status"] == "done").all())
+        self.assertFalse(results_df["val_loss"].isna().any())
+
+        # The promoted trials are continued, not trained again from scratch
+        rungs = [set(results_df[results_df["rung"] == rung]["task_id"]) for rung in range(3)]
+        self.assertTrue(rungs[2] <= rungs[1] <= rungs[0])
+        (best_task_id,) = rungs[2]
+        history_df = pd.read_csv(
+            get_history_path(get_task_dir(SupervisedModelTraining, best_task_id))
+        )
+        self.assertEqual([0, 1, 2, 3], history_df["epoch"].tolist())
+
 
 if __name__ == "__main__":
     unittest.main()
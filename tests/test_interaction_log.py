@@ -0,0 +1,115 @@
+import collections
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from mars_gym.data.interaction_log import InteractionLog, ItemActionCounter, UserItemCounter
+
+
+class TestInteractionLog(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.dtypes = {"user_idx": np.dtype("int64"), "item_idx": np.dtype("int64")}
+        self.rows = [
+            {
+                "user_idx": int(rng.randint(100)),
+                "session": "s%d" % i,
+                "arms": rng.randint(50, size=rng.randint(0, 5)).tolist(),
+                "item_idx": int(rng.randint(50)),
+                "ps": rng.rand(),
+            }
+            for i in range(3000)
+        ]
+
+    def test_to_data_frame_matches_rows(self):
+        log = InteractionLog(self.dtypes, capacity=16)
+        for row in self.rows:
+            log.append(row)
+
+        df = log.to_data_frame()
+        self.assertEqual(len(log), len(self.rows))
+        self.assertEqual(df.columns.tolist(), ["user_idx", "item_idx", "session", "arms", "ps"])
+        self.assertEqual(df["item_idx"].dtype, np.dtype("int64"))
+        pd.testing.assert_frame_equal(df, pd.DataFrame(self.rows, columns=df.columns))
+
+    def test_empty_log_keeps_the_dtypes(self):
+        df = InteractionLog(self.dtypes).to_data_frame()
+
+        self.assertEqual(len(df), 0)
+        self.assertEqual(df.dtypes.to_dict(), self.dtypes)
+
+
+class TestUserItemCounter(unittest.TestCase):
+    def test_get_matches_counts(self):
+        rng = np.random.RandomState(42)
+        counter = UserItemCounter(n_items=50, buffer_size=37)
+        expected = collections.defaultdict(lambda: [0, 0])
+
+        for step in range(2000):
+            user, item, output = rng.randint(30), rng.randint(50), rng.randint(2)
+            counter.add(user, item, output)
+            expected[(user, item)][0] += 1
+            expected[(user, item)][1] += output
+
+            if step % 97 == 0:
+                users, items = rng.randint(30, size=200), rng.randint(50, size=200)
+                views, outputs = counter.get(users, items)
+                for i, (user, item) in enumerate(zip(users, items)):
+                    self.assertEqual(
+                        [views[i], outputs[i]], expected.get((user, item), [0, 0])
+                    )
+
+        self.assertEqual(len(counter), len(expected))
+
+
+class TestItemActionCounter(unittest.TestCase):
+    def setUp(self):
+        self.actions = np.random.RandomState(42).randint(20, size=1000)
+        self.items = np.arange(20)
+
+    def test_probs_match_value_counts(self):
+        counter = ItemActionCounter(n_items=20)
+        window_counter = ItemActionCounter(n_items=20, window=100)
+        self.assertEqual(counter.probs(self.items).tolist(), [0.0] * 20)
+
+        for action in self.actions:
+            counter.add(action)
+            window_counter.add(action)
+
+        counts = pd.Series(self.actions).value_counts(normalize=True)
+        np.testing.assert_allclose(counter.probs(self.items), counts.reindex(self.items, fill_value=0))
+        counts = pd.Series(self.actions[-100:]).value_counts(normalize=True)
+        np.testing.assert_allclose(
+            window_counter.probs(self.items), counts.reindex(self.items, fill_value=0)
+        )
+
+    def test_decayed_probs_in_batches(self):
+        counter = ItemActionCounter(n_items=20, decay=0.9)
+        counter.add(self.actions[:300])
+        counter.add(self.actions[300:])
+
+        weights = 0.9 ** np.arange(len(self.actions))[::-1]
+        np.testing.assert_allclose(
+            counter.probs(self.items),
+            np.bincount(self.actions, weights=weights, minlength=20) / weights.sum(),
+        )
+
+    def test_decayed_probs_in_a_large_batch(self):
+        actions = np.random.RandomState(42).randint(10, size=1200)
+        counter = ItemActionCounter(n_items=10, decay=0.5)
+        counter.add(actions)
+
+        probs = counter.probs(np.arange(10))
+        self.assertTrue(np.isfinite(probs).all())
+        self.assertAlmostEqual(probs.sum(), 1.0)
+
+        # Only the last actions are relevant with this decay, the older weights underflow
+        weights = 0.5 ** np.arange(100)[::-1]
+        np.testing.assert_allclose(
+            probs, np.bincount(actions[-100:], weights=weights, minlength=10) / weights.sum()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
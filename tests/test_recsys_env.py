@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from mars_gym.gym.envs.recsys import IndexList, RecSysEnv
+
+
+class TestRecSysEnv(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.df = pd.DataFrame(
+            {
+                "user_idx": rng.randint(10, size=100),
+                "item_idx": rng.randint(1, 50, size=100),
+                "available_arms": [
+                    rng.randint(1, 50, size=rng.randint(1, 8)).tolist() for _ in range(100)
+                ],
+            }
+        )
+
+    def test_available_items_as_indices(self):
+        env = RecSysEnv(self.df, "item_idx", 50, "available_arms")
+        dense_env = RecSysEnv(
+            self.df, "item_idx", 50, "available_arms", dense_available_items=True
+        )
+        self.assertEqual(env.observation_space["available_arms"], IndexList(50))
+
+        ob, dense_ob = env.reset(), dense_env.reset()
+        for available_arms in self.df["available_arms"][:-1]:
+            self.assertEqual(ob["available_arms"].tolist(), sorted(set(available_arms)))
+            self.assertTrue(env.observation_space["available_arms"].contains(ob["available_arms"]))
+            np.testing.assert_array_equal(
+                np.flatnonzero(dense_ob["available_arms"]), ob["available_arms"]
+            )
+
+            action = int(ob["available_arms"][0])
+            ob, reward, done, _ = env.step(action)
+            dense_ob, dense_reward, _, _ = dense_env.step(action)
+            self.assertEqual(reward, dense_reward)
+            if done:
+                break
+
+        self.assertTrue(done)
+
+    def test_available_items_as_arrays(self):
+        df = self.df.assign(available_arms=self.df["available_arms"].map(np.array))
+        env = RecSysEnv(df, "item_idx", 50, "available_arms")
+
+        ob = env.reset()
+        self.assertEqual(ob["available_arms"].tolist(), sorted(set(self.df["available_arms"][0])))
+
+
+if __name__ == "__main__":
+    unittest.main()
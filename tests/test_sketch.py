@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from mars_gym.utils.sketch import ScoreDistribution, StreamingHistogram
+
+
+class TestScoreDistribution(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.scores = np.concatenate([rng.rand(5000), rng.randn(5000)])
+
+    def test_quantiles_within_relative_accuracy(self):
+        distribution = ScoreDistribution(relative_accuracy=0.01)
+        for chunk in np.array_split(self.scores, 7):
+            distribution.update(chunk)
+
+        self.assertEqual(distribution.count, len(self.scores))
+        for q in (0.05, 0.5, 0.95):
+            expected = np.quantile(self.scores, q)
+            self.assertLess(
+                abs(distribution.sketch.quantile(q) - expected), 0.02 * abs(expected)
+            )
+
+    def test_merge_and_round_trip(self):
+        whole = ScoreDistribution()
+        whole.update(self.scores)
+
+        first, second = ScoreDistribution(), ScoreDistribution()
+        first.update(self.scores[:3000])
+        second.update(self.scores[3000:])
+        merged = ScoreDistribution.from_dict(first.to_dict())
+        merged.merge(ScoreDistribution.from_dict(second.to_dict()))
+
+        self.assertEqual(merged.sketch.quantiles(), whole.sketch.quantiles())
+        np.testing.assert_array_equal(merged.histogram.edges, whole.histogram.edges)
+        np.testing.assert_array_equal(merged.histogram.counts, whole.histogram.counts)
+        self.assertEqual(merged.histogram.counts.sum(), len(self.scores))
+
+    def test_histogram_bins_grow_with_the_range(self):
+        rng = np.random.RandomState(42)
+        scores = np.concatenate([0.1 * rng.rand(1000), 0.1 + 0.9 * rng.rand(100000)])
+
+        histogram = StreamingHistogram()
+        histogram.update(scores[:1000])
+        histogram.update(scores[1000:])
+
+        self.assertLessEqual(histogram.edges[0], scores.min())
+        self.assertGreater(histogram.edges[-1], scores.max())
+        self.assertEqual(histogram.counts.sum(), len(scores))
+        np.testing.assert_array_equal(
+            histogram.counts, np.histogram(scores, bins=histogram.edges)[0]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()